@@ -8,20 +8,37 @@ This module provides a unified interface for integrating multiple AI platforms
 including LLM Direct, Coze, and Dify platforms.
 """
 
-from .base_platform import BasePlatform
-from .platform_router import PlatformRouter
-from .llm_direct import LLMDirectPlatform
+import importlib
 
-# 导出配置相关函数
-from .manager import (
-    parse_listen_list,
-    create_platform_router,
-    validate_platform_configs,
-    print_platform_info,
-    init_global_router,
-    get_global_router,
-    route_user_message
-)
+# 导出的类和配置相关函数在首次访问时才导入子模块（PEP 562），
+# 只用到某个子模块时不必加载其余平台的依赖
+_LAZY_EXPORTS = {
+    # 核心类
+    'BasePlatform': '.base_platform',
+    'PlatformRouter': '.platform_router',
+    'LLMDirectPlatform': '.llm_direct',
+    
+    # 配置函数
+    'parse_listen_list': '.manager',
+    'create_platform_router': '.manager',
+    'validate_platform_configs': '.manager',
+    'print_platform_info': '.manager',
+    'init_global_router': '.manager',
+    'get_global_router': '.manager',
+    'route_user_message': '.manager',
+}
+
+def __getattr__(name):
+    """按需导入导出的符号，并缓存到模块命名空间"""
+    module_name = _LAZY_EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_EXPORTS))
 
 # 延迟导入，避免循环依赖
 def get_coze_platform():
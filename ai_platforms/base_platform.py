@@ -1,10 +1,156 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
+import os
+import re
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
+# orjson 可选，格式化错误日志中的消息体更快；未安装时使用标准库
+try:
+    import orjson
+    
+    def dump_messages(messages):
+        """格式化消息列表用于错误日志"""
+        return orjson.dumps(messages, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode('utf-8')
+except ImportError:
+    def dump_messages(messages):
+        """格式化消息列表用于错误日志"""
+        return json.dumps(messages, ensure_ascii=False, indent=2)
+
+# 连接测试结果的缓存时间（秒），避免启动/健康检查时重复请求真实API
+_TEST_CONNECTION_TTL = 60
+
+# 错误分类规则表：(关键词元组, 提示消息)，按优先级排列
+_ERROR_RULES = (
+    (("rate limit",), "抱歉，AI服务访问频率过高，请稍后再试。"),
+    (("quota", "billing"), "抱歉，AI服务余额不足，请联系管理员。"),
+    (("timeout",), "抱歉，AI服务响应超时，请稍后再试。"),
+    (("authentication", "unauthorized"), "抱歉，AI服务认证失败，请联系管理员。"),
+)
+
+def compile_error_classifier(rules):
+    """
+    将 (关键词元组, 结果) 规则表编译为错误分类函数
+    
+    所有关键词合并为一个忽略大小写的正则，只需扫描错误信息一遍；
+    多个关键词同时出现时，按规则表顺序返回优先级最高的结果
+    
+    Args:
+        rules (tuple): 规则表，按优先级排列
+    
+    Returns:
+        function: classify(text, default=None)，返回命中规则的结果或 default
+    """
+    priority = {}
+    for index, (keywords, _) in enumerate(rules):
+        for keyword in keywords:
+            priority.setdefault(keyword.lower(), index)
+    # 长关键词优先，避免被其前缀抢先匹配
+    pattern = re.compile(
+        "|".join(re.escape(keyword) for keyword in sorted(priority, key=len, reverse=True)),
+        re.IGNORECASE
+    )
+    
+    def classify(text, default=None):
+        matched = pattern.findall(text)
+        if not matched:
+            return default
+        return rules[min(priority[keyword.lower()] for keyword in matched)][1]
+    
+    return classify
+
+_classify_error = compile_error_classifier(_ERROR_RULES)
+
+# 工具调用（store_context=False）回复缓存：相同平台、提示词和消息在有效期内直接复用上次的回复
+_TOOL_REPLY_CACHE_SIZE = 256
+_TOOL_REPLY_CACHE_TTL = _TEST_CONNECTION_TTL
+_tool_reply_cache = OrderedDict()  # {(平台类, 用户ID, 系统提示词, 消息, 是否总结): (时间戳, 回复)}
+_tool_reply_cache_lock = threading.Lock()
+_tool_inflight = {}  # 进行中的工具调用 {缓存键: Future}，相同请求并发到达时共用一次API调用（受 _tool_reply_cache_lock 保护）
+
+def _get_cached_tool_reply(key):
+    """返回未过期的缓存回复，没有时返回 None"""
+    with _tool_reply_cache_lock:
+        cached = _tool_reply_cache.get(key)
+        if cached is None:
+            return None
+        if time.time() - cached[0] >= _TOOL_REPLY_CACHE_TTL:
+            del _tool_reply_cache[key]
+            return None
+        _tool_reply_cache.move_to_end(key)
+        return cached[1]
+
+def _put_cached_tool_reply(key, reply):
+    """缓存工具调用回复，超出容量时淘汰最久未使用的条目"""
+    with _tool_reply_cache_lock:
+        _tool_reply_cache[key] = (time.time(), reply)
+        _tool_reply_cache.move_to_end(key)
+        if len(_tool_reply_cache) > _TOOL_REPLY_CACHE_SIZE:
+            _tool_reply_cache.popitem(last=False)
+
+class PlatformReplyError(Exception):
+    """
+    平台调用失败，但已准备好给用户的提示语
+    
+    get_response 直接返回 reply，不写入上下文，也不进入工具调用缓存
+    """
+    
+    def __init__(self, reply):
+        super().__init__(reply)
+        self.reply = reply
+
+_bot_module_lock = threading.Lock()
+
+def _recent_history(history, budget):
+    """
+    从最新的消息往前取历史记录，总字符数不超过 budget
+    
+    单条超长消息会挤掉更早的记录，避免请求体过大导致延迟升高或被服务端拒绝
+    """
+    recent = []
+    for history_message in reversed(history):
+        budget -= len(history_message.get("content") or "")
+        if budget < 0:
+            break
+        recent.append(history_message)
+    recent.reverse()
+    return recent
+
+@lru_cache(maxsize=1024)
+def _cached_system_message(bot, user_id, file_key):
+    """
+    按 (用户, prompt文件的 mtime 和大小) 缓存系统提示词消息，文件修改后自动失效
+    
+    缓存的消息会在多轮对话及各平台实例间共享，调用方不应修改它
+    """
+    return {"role": "system", "content": bot.get_user_prompt(user_id)}
+
+def _ensure_bot_loaded():
+    """
+    延迟加载bot模块避免循环依赖（进程内只导入一次，所有平台实例共享）
+    
+    Returns:
+        module: bot模块
+    """
+    if BasePlatform._bot_module is None:
+        with _bot_module_lock:
+            if BasePlatform._bot_module is None:
+                try:
+                    import bot
+                except ImportError as e:
+                    logger.error(f"无法导入bot模块: {e}")
+                    raise
+                BasePlatform._bot_module = bot
+    return BasePlatform._bot_module
+
 class BasePlatform(ABC):
     """
     AI平台基类
@@ -13,34 +159,24 @@ class BasePlatform(ABC):
     子类只需要实现具体的API调用逻辑
     """
     
+    # 实例属性固定，使用 __slots__ 省去每个实例的 __dict__
+    __slots__ = ('config', '_last_test')
+    
+    # bot模块用于上下文管理，由 _ensure_bot_loaded() 在首次使用时填充
+    _bot_module = None
+    
     def __init__(self, config):
         """初始化平台"""
         self.config = config or {}
         
-        # 导入bot模块用于上下文管理（延迟导入避免循环依赖）
-        self._bot_module = None
-        self._context_limit = None
+        # 最近一次连接测试的 (时间戳, 结果)
+        self._last_test = (0.0, False)
         
         logger.info(f"{self.__class__.__name__} 初始化完成")
     
     def _get_bot_module(self):
-        """延迟加载bot模块避免循环依赖"""
-        if self._bot_module is None:
-            try:
-                import sys
-                import os
-                sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-                import bot
-                self._bot_module = bot
-                
-                # 获取上下文限制
-                from config import MAX_GROUPS
-                self._context_limit = MAX_GROUPS * 2
-                
-            except ImportError as e:
-                logger.error(f"无法导入bot模块: {e}")
-                raise
-        return self._bot_module
+        """获取bot模块（首次调用时加载）"""
+        return self._bot_module or _ensure_bot_loaded()
     
     @abstractmethod
     def validate_config(self):
@@ -76,10 +212,42 @@ class BasePlatform(ABC):
         Returns:
             str: AI回复内容
         """
+        if store_context:
+            return self._get_response(message, user_id, store_context, is_summary, system_prompt)
+        
+        # 工具调用（如提醒解析、总结）：完全相同的请求直接返回缓存的回复，
+        # 并发到达时只由第一个请求调用API，其余等待其结果
+        cache_key = (self.__class__, user_id, system_prompt, message, is_summary)
+        cached_reply = _get_cached_tool_reply(cache_key)
+        if cached_reply is not None:
+            logger.info("工具调用命中缓存，ID: %s", user_id)
+            return cached_reply
+        
+        with _tool_reply_cache_lock:
+            future = _tool_inflight.get(cache_key)
+            is_owner = future is None
+            if is_owner:
+                future = _tool_inflight[cache_key] = Future()
+        
+        if not is_owner:
+            logger.info("相同的工具调用正在进行中，等待其结果，ID: %s", user_id)
+            return future.result()
+        
         try:
-            bot = self._get_bot_module()
-            
-            logger.info(f"调用 {self.__class__.__name__} API - ID: {user_id}, 存储上下文: {store_context}, 消息: {message[:100]}...")
+            reply = self._get_response(message, user_id, store_context, is_summary, system_prompt, cache_key)
+            future.set_result(reply)
+            return reply
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with _tool_reply_cache_lock:
+                del _tool_inflight[cache_key]
+    
+    def _get_response(self, message, user_id, store_context, is_summary, system_prompt, cache_key=None):
+        """获取AI响应（不经过工具调用缓存和合并），cache_key 不为空时缓存成功的回复"""
+        try:
+            logger.info("调用 %s API - ID: %s, 存储上下文: %s, 消息: %.100s...", self.__class__.__name__, user_id, store_context, message)
             
             # 构建消息列表
             messages_to_send = []
@@ -91,10 +259,10 @@ class BasePlatform(ABC):
                 # 处理工具调用（如提醒解析、总结）
                 if system_prompt:
                     messages_to_send.append({"role": "system", "content": system_prompt})
-                    logger.info(f"工具调用使用自定义系统提示词 - ID: {user_id}")
+                    logger.info("工具调用使用自定义系统提示词 - ID: %s", user_id)
                 
                 messages_to_send.append({"role": "user", "content": message})
-                logger.info(f"工具调用 (store_context=False)，ID: {user_id}")
+                logger.info("工具调用 (store_context=False)，ID: %s", user_id)
             
             # 调用具体平台的API
             reply = self._call_api(messages_to_send, user_id, is_summary=is_summary)
@@ -102,19 +270,28 @@ class BasePlatform(ABC):
             # 存储助手回复到上下文中
             if store_context:
                 self._save_assistant_response(user_id, reply)
+            elif reply and cache_key is not None:
+                # 失败时 _call_api 抛出异常（含 PlatformReplyError），走不到这里，只缓存成功的回复
+                _put_cached_tool_reply(cache_key, reply)
             
             return reply
             
         except Exception as e:
-            logger.error(f"{self.__class__.__name__} 调用失败 (ID: {user_id}): {str(e)}", exc_info=True)
+            if store_context and self._bot_module is not None:
+                # 没有助手回复时也要保存已追加的用户消息
+                self._bot_module.mark_chat_contexts_dirty()
+            if isinstance(e, PlatformReplyError):
+                logger.warning("%s 调用失败 (ID: %s)，返回提示: %s", self.__class__.__name__, user_id, e.reply)
+                return e.reply
+            logger.error("%s 调用失败 (ID: %s): %s", self.__class__.__name__, user_id, e, exc_info=True)
             return "抱歉，我现在有点忙，稍后再聊吧。"
     
     def _build_context_messages(self, message, user_id, system_prompt=None):
         """构建包含上下文的消息列表"""
         bot = self._get_bot_module()
         
-        # 重新加载聊天上下文
-        bot.load_chat_contexts()
+        # 仅在上下文文件被外部修改时重新加载，内存中的上下文即为最新状态
+        bot.reload_chat_contexts_if_changed()
         
         messages_to_send = []
         
@@ -122,55 +299,55 @@ class BasePlatform(ABC):
         try:
             if system_prompt:
                 messages_to_send.append({"role": "system", "content": system_prompt})
-                logger.info(f"使用自定义系统提示词 - 用户: {user_id}")
+                logger.info("使用自定义系统提示词 - 用户: %s", user_id)
             else:
-                user_prompt = bot.get_user_prompt(user_id)
-                messages_to_send.append({"role": "system", "content": user_prompt})
+                messages_to_send.append(self._get_user_system_message(bot, user_id))
         except FileNotFoundError as e:
-            logger.error(f"用户 {user_id} 的提示文件错误: {e}，使用默认提示。")
+            logger.error("用户 %s 的提示文件错误: %s，使用默认提示。", user_id, e)
             fallback_prompt = system_prompt if system_prompt else "你是一个乐于助人的助手。"
             messages_to_send.append({"role": "system", "content": fallback_prompt})
         
-        # 2. 管理聊天历史记录
+        # 2. 管理聊天历史记录（锁内只做历史快照和追加）
+        user_message = {"role": "user", "content": message}
         with bot.queue_lock:
-            if user_id not in bot.chat_contexts:
-                bot.chat_contexts[user_id] = []
-            
-            # 获取历史记录并裁剪
-            history = list(bot.chat_contexts.get(user_id, []))
-            if len(history) > self._context_limit:
-                history = history[-self._context_limit:]
-            
-            # 添加历史消息
-            messages_to_send.extend(history)
+            history = bot.chat_contexts[user_id]  # defaultdict，新用户自动创建定长 deque
             
-            # 添加当前用户消息
-            messages_to_send.append({"role": "user", "content": message})
+            # 添加历史消息（deque 已按条数定长，这里再按字符数预算省略最旧的消息）
+            messages_to_send.extend(_recent_history(history, bot.CHAT_CONTEXT_CHAR_BUDGET - len(message)))
             
-            # 更新持久上下文
-            bot.chat_contexts[user_id].append({"role": "user", "content": message})
-            if len(bot.chat_contexts[user_id]) > self._context_limit + 1:
-                bot.chat_contexts[user_id] = bot.chat_contexts[user_id][-(self._context_limit + 1):]
-            
-            # 保存上下文
-            bot.save_chat_contexts()
+            # 更新持久上下文（deque 定长，超出部分自动淘汰）
+            history.append(user_message)
+            bot.chat_contexts_dirty_users.add(user_id)
+        
+        # 添加当前用户消息
+        messages_to_send.append(user_message)
         
+        # 用户消息与助手回复在本轮结束时一起标记写盘（见 _save_assistant_response）
         return messages_to_send
     
+    def _get_user_system_message(self, bot, user_id):
+        """
+        获取用户的系统提示词消息
+        
+        Prompt文件未修改（mtime和大小不变）时复用缓存的消息，避免每轮对话都读取文件
+        """
+        try:
+            stat = os.stat(bot.get_user_prompt_path(user_id))
+        except OSError:
+            # 文件不存在时不缓存，交给 get_user_prompt 处理
+            return {"role": "system", "content": bot.get_user_prompt(user_id)}
+        
+        return _cached_system_message(bot, user_id, (stat.st_mtime_ns, stat.st_size))
+    
     def _save_assistant_response(self, user_id, reply):
         """保存助手回复到上下文"""
         bot = self._get_bot_module()
         
         with bot.queue_lock:
-            if user_id not in bot.chat_contexts:
-                bot.chat_contexts[user_id] = []
-            
             bot.chat_contexts[user_id].append({"role": "assistant", "content": reply})
-            
-            if len(bot.chat_contexts[user_id]) > self._context_limit:
-                bot.chat_contexts[user_id] = bot.chat_contexts[user_id][-self._context_limit:]
-            
-            bot.save_chat_contexts()
+            bot.chat_contexts_dirty_users.add(user_id)
+        
+        bot.mark_chat_contexts_dirty()
     
     def handle_error(self, error, user_id):
         """
@@ -184,19 +361,10 @@ class BasePlatform(ABC):
             str: 错误提示消息
         """
         error_msg = str(error)
-        logger.error(f"平台 {self.__class__.__name__} 用户 {user_id} 发生错误: {error_msg}")
-        
-        # 根据错误类型返回不同的提示
-        if "rate limit" in error_msg.lower():
-            return "抱歉，AI服务访问频率过高，请稍后再试。"
-        elif "quota" in error_msg.lower() or "billing" in error_msg.lower():
-            return "抱歉，AI服务余额不足，请联系管理员。"
-        elif "timeout" in error_msg.lower():
-            return "抱歉，AI服务响应超时，请稍后再试。"
-        elif "authentication" in error_msg.lower() or "unauthorized" in error_msg.lower():
-            return "抱歉，AI服务认证失败，请联系管理员。"
-        else:
-            return "抱歉，AI服务暂时不可用，请稍后再试。"
+        logger.error("平台 %s 用户 %s 发生错误: %s", self.__class__.__name__, user_id, error_msg)
+        
+        # 根据错误类型返回不同的提示（单次正则扫描，按规则表优先级取结果）
+        return _classify_error(error_msg, "抱歉，AI服务暂时不可用，请稍后再试。")
     
     def get_platform_name(self):
         """
@@ -228,9 +396,15 @@ class BasePlatform(ABC):
         """
         测试平台连接
         
+        短时间内重复调用时直接返回上次的测试结果
+        
         Returns:
             bool: 连接是否正常
         """
+        tested_at, last_result = self._last_test
+        if time.time() - tested_at < _TEST_CONNECTION_TTL:
+            return last_result
+        
         try:
             # 发送一个简单的测试消息
             test_response = self.get_response(
@@ -240,7 +414,10 @@ class BasePlatform(ABC):
                 is_summary=False,
                 system_prompt=None
             )
-            return bool(test_response and len(test_response.strip()) > 0)
+            result = bool(test_response and len(test_response.strip()) > 0)
         except Exception as e:
             logger.error(f"平台 {self.get_platform_name()} 连接测试失败: {e}")
-            return False 
\ No newline at end of file
+            result = False
+        
+        self._last_test = (time.time(), result)
+        return result 
\ No newline at end of file
@@ -1,20 +1,37 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
 import os
+import sys
+import threading
 import time
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
-from .base_platform import BasePlatform
+from .base_platform import BasePlatform, PlatformReplyError, compile_error_classifier
 from cozepy import COZE_CN_BASE_URL, Coze, TokenAuth
 
 logger = logging.getLogger(__name__)
 
+# orjson 可选，解析工作流返回的JSON更快；未安装时使用标准库
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# 项目根目录（config.py 所在目录），模块加载时确定一次
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# token持久化文件，避免每次刷新token都改写config.py源码
+# 内容为 {凭据标识: {'current_token': ..., 'token_expires_at': ...}}，更换应用或公钥后不会误用旧token
+_TOKEN_FILE = os.path.join(_PROJECT_ROOT, '.coze_token.json')
+
 # 导入现有配置
 try:
-    import sys
-    import os
     # 添加项目根目录到路径
-    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if _PROJECT_ROOT not in sys.path:
+        sys.path.insert(0, _PROJECT_ROOT)
     
     from config import COZE_CONFIG
 except ImportError as e:
@@ -34,6 +51,112 @@ except ImportError as e:
         'stream': False
     }
 
+# token持久化在单独的线程中串行执行，不阻塞请求
+# （解释器退出时 concurrent.futures 会等待已提交的写入完成）
+_persist_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="coze-token-persist")
+_token_file_lock = threading.Lock()
+
+# 错误分类规则表：(关键词元组, (日志描述, 提示消息))，按优先级排列
+_COZE_ERROR_RULES = (
+    (("authentication", "authorization", "401"), ("Coze 身份验证失败", "抱歉，身份验证失败，请检查配置。")),
+    (("rate limit", "429"), ("Coze 访问频率限制", "抱歉，访问频率过高，请稍后再试。")),
+    (("quota", "insufficient"), ("Coze 配额已用完", "抱歉，配额已用完，请联系管理员。")),
+    (("timeout",), ("Coze 请求超时", "抱歉，请求超时，请稍后再试。")),
+    (("network", "connection"), ("Coze 网络连接失败", "抱歉，网络连接失败，请稍后再试。")),
+)
+_classify_coze_error = compile_error_classifier(_COZE_ERROR_RULES)
+
+# JWT OAuth 必需的配置项
+_JWT_CONFIG_KEYS = ('client_id', 'private_key', 'public_key_id')
+
+# 工作流JSON结果中存放回复内容的字段，按优先级排列
+_REPLY_KEYS = ('data', 'content', 'message', 'text', 'output', 'answer')
+
+# 工作流结果对象（及其data属性）上可能存放输出的属性，按优先级排列
+_OUTPUT_ATTRS = ('output', 'result')
+
+def _first_attr(obj, attrs):
+    """返回 obj 上第一个非空属性值的字符串形式，都为空时返回 None"""
+    for attr in attrs:
+        value = getattr(obj, attr, None)
+        if value:
+            return str(value)
+    return None
+
+def _parse_workflow_data(workflow_data):
+    """解析字符串形式的工作流data字段，提取回复内容"""
+    try:
+        parsed_data = _json_loads(workflow_data)
+    except json.JSONDecodeError:
+        logger.debug("data字段不是有效JSON，直接使用原始字符串: %s", workflow_data)
+        return workflow_data
+    logger.debug("成功解析工作流JSON数据: %s", parsed_data)
+    
+    # 根据解析结果的结构提取消息内容
+    reply_content = ""
+    if isinstance(parsed_data, dict):
+        # 优先按标准字段直接取值，都没有时再找有意义的字符串值（假设至少10个字符）
+        reply_content = next(
+            (parsed_data[key] for key in _REPLY_KEYS if parsed_data.get(key)),
+            None
+        ) or next(
+            (value for value in parsed_data.values() if isinstance(value, str) and len(value) > 10),
+            ""
+        )
+    elif isinstance(parsed_data, str):
+        reply_content = parsed_data
+    
+    if not reply_content:
+        logger.warning(f"无法从解析的JSON中提取有效内容: {parsed_data}")
+        return workflow_data  # 降级为原始字符串
+    return reply_content
+
+def _extract_reply(workflow):
+    """
+    从工作流执行结果中提取回复内容
+    
+    结果可能在 data（JSON字符串或对象）或 output/result 属性中，按固定顺序尝试
+    """
+    workflow_data = getattr(workflow, 'data', None)
+    if workflow_data:
+        if isinstance(workflow_data, str):
+            return _parse_workflow_data(workflow_data)
+        return _first_attr(workflow_data, _OUTPUT_ATTRS) or ""
+    
+    reply_content = _first_attr(workflow, _OUTPUT_ATTRS)
+    if reply_content is None:
+        # 如果都没有，尝试直接转换整个workflow对象
+        logger.warning(f"未找到标准的工作流输出属性，使用整个结果: {workflow}")
+        return str(workflow)
+    return reply_content
+
+# 进程内JWT token缓存 {(client_id, public_key_id, api_base): (token, expires_at)}
+# 同一应用的多个平台实例共享token，命中时无需读取已保存的token或重新签发
+_token_cache = {}
+_token_cache_lock = threading.Lock()
+# 临近过期时只让一个线程读取已保存的token或重新签发，其余线程等待后直接使用其结果
+_token_refresh_lock = threading.Lock()
+
+# 进程内共享的 Coze 客户端和 JWT OAuth App（键同上），同一应用的多个平台实例复用HTTP连接池
+# 并发创建时通过 dict.setdefault 保留先写入的对象
+_coze_clients = {}
+_jwt_oauth_apps = {}
+
+class _CachedTokenAuth(TokenAuth):
+    """
+    每次请求时从进程内的token缓存中读取token（临近过期时由 getter 刷新）
+    
+    token轮换后无需重建 Coze 客户端，保留其HTTP连接池
+    """
+    
+    def __init__(self, token_getter):
+        self._token_getter = token_getter
+        super().__init__(token=token_getter())
+    
+    @property
+    def token(self) -> str:
+        return self._token_getter()
+
 class CozePlatform(BasePlatform):
     """
     Coze平台实现
@@ -42,41 +165,79 @@ class CozePlatform(BasePlatform):
     使用基类的上下文管理逻辑，确保与其他平台行为一致
     """
     
+    __slots__ = (
+        'coze_api_base', '_coze_client', '_bot_id', '_has_jwt',
+        '_jwt_oauth_app', '_ready', '_bootstrap_error',
+    )
+    
     def __init__(self, config=None):
         """初始化 Coze 平台"""
-        # 使用现有配置
+        # 使用现有配置（实例写入的token等字段只落在第一层，不复制也不修改全局配置）
         if config is None:
-            config = COZE_CONFIG.copy()
+            config = ChainMap({}, COZE_CONFIG)
         
         super().__init__(config)
         
-        # 获取API Base URL
-        self.coze_api_base = self.get_coze_api_base()
+        # 配置在实例生命周期内不变，派生字段只计算一次
+        # 获取API Base URL（优先使用环境变量，其次使用配置文件中的设置）
+        self.coze_api_base = os.getenv("COZE_API_BASE") or self.config.get('api_base_url', COZE_CN_BASE_URL)
+        self._bot_id = self.config.get('bot_id')
+        self._has_jwt = all((self.config.get(key) or '').strip() for key in _JWT_CONFIG_KEYS)
         
-        # 获取API Token
-        self.api_token = self.get_coze_api_token()
+        # JWT OAuth 应用只创建一次，token 缓存在进程内的 _token_cache 中直到临近过期
+        self._jwt_oauth_app = None
         
-        # 初始化 Coze 客户端
-        self.coze_client = Coze(
-            auth=TokenAuth(token=self.api_token), 
-            base_url=self.coze_api_base
-        )
+        # 配置缺失时立即报错；获取首个token和创建客户端需要访问网络，放到后台线程完成
+        if not self.has_jwt_oauth_config():
+            self.get_coze_api_token()
+        self._coze_client = None
+        self._bootstrap_error = None
+        self._ready = threading.Event()
+        threading.Thread(target=self._bootstrap, name="coze-bootstrap", daemon=True).start()
         
         logger.info(f"Coze 平台初始化成功，工作流 ID: {self.config.get('bot_id', '未设置')}")
     
+    def _bootstrap(self):
+        """获取首个token并创建 Coze 客户端（在后台线程中运行）"""
+        try:
+            self.get_coze_api_token()
+            # 初始化 Coze 客户端（认证时按需刷新token，客户端全程复用，相同凭据的实例共享）
+            credential_key = self._credential_key()
+            client = _coze_clients.get(credential_key)
+            if client is None:
+                client = _coze_clients.setdefault(credential_key, Coze(
+                    auth=_CachedTokenAuth(self.get_jwt_token), 
+                    base_url=self.coze_api_base
+                ))
+            self._coze_client = client
+        except Exception as e:
+            logger.error(f"Coze 客户端初始化失败: {e}")
+            self._bootstrap_error = e
+        finally:
+            self._ready.set()
+    
+    def _get_client(self):
+        """获取 Coze 客户端，后台初始化未完成时等待，失败时同步重试一次"""
+        if not self._ready.wait(timeout=self.config.get('init_timeout', 10)):
+            raise TimeoutError("Coze 客户端初始化超时")
+        if self._coze_client is None:
+            self._bootstrap()
+            if self._coze_client is None:
+                raise self._bootstrap_error
+        return self._coze_client
+    
+    @property
+    def coze_client(self):
+        """Coze 客户端（后台初始化未完成时等待其完成）"""
+        return self._get_client()
+    
     def get_platform_name(self):
         """获取平台名称"""
         return "Coze"
     
     def get_coze_api_base(self) -> str:
-        """获取 Coze API Base URL"""
-        # 优先使用环境变量
-        coze_api_base = os.getenv("COZE_API_BASE")
-        if coze_api_base:
-            return coze_api_base
-        
-        # 使用配置文件中的设置
-        return self.config.get('api_base_url', COZE_CN_BASE_URL)
+        """获取 Coze API Base URL（初始化时已确定）"""
+        return self.coze_api_base
     
     def get_coze_api_token(self) -> str:
         """获取 Coze API Token（仅支持JWT OAuth）"""
@@ -93,62 +254,102 @@ class CozePlatform(BasePlatform):
         logger.info("使用 JWT OAuth 方式获取 Token（支持自动刷新）")
         return self.get_jwt_token()
     
+    def _cached_token(self, cache_key):
+        """进程内缓存中仍在刷新阈值之外的token，没有时返回 None"""
+        refresh_threshold = self.config.get('token_refresh_threshold', 1800)
+        with _token_cache_lock:
+            cached = _token_cache.get(cache_key)
+        if cached is not None and time.time() < cached[1] - refresh_threshold:
+            self.config['current_token'], self.config['token_expires_at'] = cached
+            return cached[0]
+        return None
+    
+    def _credential_key(self):
+        """进程内缓存token和客户端使用的键"""
+        return (self.config['client_id'], self.config['public_key_id'], self.coze_api_base)
+    
+    def _token_file_key(self) -> str:
+        """.coze_token.json 中保存当前凭据token的键"""
+        return '|'.join(self._credential_key())
+    
+    def _get_jwt_oauth_app(self):
+        """获取 JWT OAuth App（首次调用时创建，相同凭据的实例共享）"""
+        if self._jwt_oauth_app is None:
+            from cozepy import JWTOAuthApp
+            
+            credential_key = self._credential_key()
+            jwt_oauth_app = _jwt_oauth_apps.get(credential_key)
+            if jwt_oauth_app is None:
+                jwt_oauth_app = _jwt_oauth_apps.setdefault(credential_key, JWTOAuthApp(
+                    client_id=self.config['client_id'],
+                    private_key=self.config['private_key'],
+                    public_key_id=self.config['public_key_id'],
+                    base_url=self.coze_api_base,
+                ))
+            self._jwt_oauth_app = jwt_oauth_app
+        return self._jwt_oauth_app
+    
     def has_jwt_oauth_config(self) -> bool:
-        """检查是否有完整的JWT OAuth配置"""
-        client_id = self.config.get('client_id')
-        private_key = self.config.get('private_key')
-        public_key_id = self.config.get('public_key_id')
-        
-        return (
-            client_id is not None and client_id.strip() != '' and
-            private_key is not None and private_key.strip() != '' and
-            public_key_id is not None and public_key_id.strip() != ''
-        )
+        """检查是否有完整的JWT OAuth配置（初始化时已确定）"""
+        return self._has_jwt
     
     def get_jwt_token(self) -> str:
-        """使用JWT OAuth获取token"""
+        """使用JWT OAuth获取token（每次请求认证时调用，通常直接命中进程内缓存）"""
+        cache_key = self._credential_key()
+        
+        # 优先使用进程内缓存的token
+        token = self._cached_token(cache_key)
+        if token is not None:
+            return token
+        
+        with _token_refresh_lock:
+            # 等锁期间其他线程可能已刷新
+            token = self._cached_token(cache_key)
+            if token is not None:
+                return token
+            return self._refresh_jwt_token(cache_key)
+    
+    def _refresh_jwt_token(self, cache_key) -> str:
+        """读取已保存的token或重新签发，并写入进程内缓存（调用方持有 _token_refresh_lock）"""
         try:
-            # 先检查config.py中是否有有效的缓存token
+            # 再检查已保存的token是否有效
             cached_token = self.load_token_from_config()
             if cached_token:
                 # 使用缓存的token
                 self.config['current_token'] = cached_token
+                with _token_cache_lock:
+                    _token_cache[cache_key] = (cached_token, self.config['token_expires_at'])
                 return cached_token
             
             # 缓存中没有有效token，获取新的
             logger.info("正在获取新的JWT OAuth token...")
             
-            from cozepy import JWTAuth, JWTOAuthApp
-            
-            # 创建 JWT OAuth App
-            jwt_oauth_app = JWTOAuthApp(
-                client_id=self.config['client_id'],
-                private_key=self.config['private_key'],
-                public_key_id=self.config['public_key_id'],
-                base_url=self.coze_api_base,
-            )
+            # 复用 JWT OAuth App
+            jwt_oauth_app = self._get_jwt_oauth_app()
             
             # 获取token - 使用最大有效期
             oauth_token = jwt_oauth_app.get_access_token(ttl=86399)  # 最大24小时有效期
             logger.info("JWT OAuth token 获取成功，oauth_token: %s", oauth_token)
             
             # 处理过期时间 - expires_in可能是时间戳而不是秒数
-            current_time = time.time()
-            expires_in_value = oauth_token.expires_in
-            
-            expires_at = expires_in_value
-            logger.info(f"过期时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expires_at))}")
+            expires_at = oauth_token.expires_in
             
-            # 计算实际剩余时间
-            remaining_hours = (expires_at - current_time) / 3600
-            logger.info(f"Token实际剩余有效期: {remaining_hours:.1f} 小时")
+            # 过期时间和实际剩余时间只用于日志，仅在需要输出时计算一次
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "过期时间: %s，Token实际剩余有效期: %.1f 小时",
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expires_at)),
+                    (expires_at - time.time()) / 3600
+                )
             
             # 保存token到实例配置中（仅在内存中）
             self.config['current_token'] = oauth_token.access_token
             self.config['token_expires_at'] = expires_at
+            with _token_cache_lock:
+                _token_cache[cache_key] = (oauth_token.access_token, expires_at)
             
-            # 回写token到config.py文件
-            self.save_token_to_config(oauth_token.access_token, expires_at)
+            # 后台保存token（内存中的token已可用）
+            _persist_pool.submit(self.save_token_to_config, oauth_token.access_token, expires_at)
             
             return oauth_token.access_token
             
@@ -159,7 +360,7 @@ class CozePlatform(BasePlatform):
     def validate_config(self):
         """验证配置是否有效"""
         # 检查工作流ID（bot_id字段现在用作workflow_id）
-        if not self.config.get('bot_id') or self.config['bot_id'] == 'your-bot-id':
+        if not self._bot_id or self._bot_id == 'your-bot-id':
             raise ValueError("Coze 配置中的 bot_id 无效，请设置正确的工作流 ID（Workflow ID）")
         
         # 检查API Token（这里不直接验证，留给 get_coze_api_token 方法处理）
@@ -176,23 +377,21 @@ class CozePlatform(BasePlatform):
         
         Returns:
             str: AI回复内容
+        
+        Raises:
+            PlatformReplyError: 调用失败或无有效输出时抛出，携带给用户的提示语
         """
         try:
             # 为保持与LLM Direct完全一致的行为，我们只传递当前消息给Coze
             # 让基类的上下文管理完全接管历史管理，而不依赖Coze平台的自动上下文
-            current_message = ""
-            system_prompt = None
-            
-            logger.debug(f"coze消息，messages: {messages}")
-            # 只提取当前消息和系统提示词
-            for msg in messages:
-                if msg["role"] == "system":
-                    system_prompt = msg["content"]
-                elif msg["role"] == "user":
-                    current_message = msg["content"]  # 使用最后一条用户消息
-            logger.debug(f"coze system_prompt: {system_prompt}")
-            logger.info(f"调用 Coze API - 用户: {user_id}, 当前消息: {current_message[:100]}...")
-            logger.info(f"注意: 使用基类上下文管理，确保与LLM Direct行为完全一致")
+            logger.debug("coze消息，messages: %s", messages)
+            # 只提取当前消息和系统提示词：当前消息是最后一条用户消息（从末尾查找），
+            # 系统提示词由基类放在列表开头（从开头查找），两者通常第一条即命中
+            current_message = next((msg["content"] for msg in reversed(messages) if msg["role"] == "user"), "")
+            system_prompt = next((msg["content"] for msg in messages if msg["role"] == "system"), None)
+            logger.debug("coze system_prompt: %s", system_prompt)
+            logger.info("调用 Coze API - 用户: %s, 当前消息: %.100s...", user_id, current_message)
+            logger.info("注意: 使用基类上下文管理，确保与LLM Direct行为完全一致")
             
             # 构建工作流参数 - 工作流模式下不需要additional_messages
             parameters = None
@@ -202,99 +401,44 @@ class CozePlatform(BasePlatform):
                 parameters = {"input": current_message}
             
             # 打印请求参数日志
-            logger.info(f"Coze工作流请求参数: workflow_id={self.config['bot_id']}, user_id={user_id}, parameters={parameters}")
+            logger.info("Coze工作流请求参数: workflow_id=%s, user_id=%s, parameters=%s", self._bot_id, user_id, parameters)
             
             workflow = None  # 先定义，便于异常时打印
             # 使用工作流替代对话流，更适合群聊助手场景
             # Call the coze.workflows.runs.create method to create a workflow run
-            workflow = self.coze_client.workflows.runs.create(
-                workflow_id=self.config['bot_id'],
+            workflow = self._get_client().workflows.runs.create(
+                workflow_id=self._bot_id,
                 parameters=parameters
             )
             
             # 打印Coze API原始返回内容
-            logger.info(f"Coze 工作流API原始返回: {repr(workflow)}")
+            logger.info("Coze 工作流API原始返回: %r", workflow)
             
             # 检查工作流执行状态和提取结果
             if workflow:
                 # 提取工作流执行结果
-                reply_content = ""
                 try:
-                    # 工作流结果可能在不同的属性中，尝试多种可能的结构
-                    workflow_data = getattr(workflow, 'data', None)
-                    if workflow_data:
-                        # 如果结果在data属性中
-                        if isinstance(workflow_data, str):
-                            # 尝试解析JSON格式的data字段
-                            try:
-                                import json
-                                parsed_data = json.loads(workflow_data)
-                                logger.debug(f"成功解析工作流JSON数据: {parsed_data}")
-                                
-                                # 根据解析结果的结构提取消息内容
-                                if isinstance(parsed_data, dict):
-                                    # 优先获取data字段中的内容
-                                    if 'data' in parsed_data:
-                                        reply_content = parsed_data['data']
-                                    elif 'content' in parsed_data:
-                                        reply_content = parsed_data['content']
-                                    elif 'message' in parsed_data:
-                                        reply_content = parsed_data['message']
-                                    else:
-                                        # 如果没有标准字段，尝试获取所有字符串值
-                                        for key, value in parsed_data.items():
-                                            if isinstance(value, str) and len(value) > 10:  # 假设有意义的回复至少10个字符
-                                                reply_content = value
-                                                break
-                                elif isinstance(parsed_data, str):
-                                    reply_content = parsed_data
-                                
-                                if not reply_content:
-                                    logger.warning(f"无法从解析的JSON中提取有效内容: {parsed_data}")
-                                    reply_content = workflow_data  # 降级为原始字符串
-                                    
-                            except json.JSONDecodeError:
-                                logger.debug(f"data字段不是有效JSON，直接使用原始字符串: {workflow_data}")
-                                reply_content = workflow_data
-                        else:
-                            data_output = getattr(workflow_data, 'output', None)
-                            data_result = getattr(workflow_data, 'result', None)
-                            if data_output:
-                                reply_content = str(data_output)
-                            elif data_result:
-                                reply_content = str(data_result)
-                    else:
-                        # 尝试直接获取output或result属性
-                        workflow_output = getattr(workflow, 'output', None)
-                        workflow_result = getattr(workflow, 'result', None)
-                        
-                        if workflow_output:
-                            reply_content = str(workflow_output)
-                        elif workflow_result:
-                            reply_content = str(workflow_result)
-                        else:
-                            # 如果都没有，尝试直接转换整个workflow对象
-                            reply_content = str(workflow)
-                            logger.warning(f"未找到标准的工作流输出属性，使用整个结果: {workflow}")
-                        
+                    reply_content = _extract_reply(workflow)
                 except Exception as msg_error:
                     logger.warning(f"提取工作流结果时出错: {msg_error}")
-                    reply_content = "抱歉，我现在有点忙，稍后再聊吧。"
+                    reply_content = None
                 
                 if reply_content and reply_content.strip():
-                    logger.info(f"Coze 工作流执行成功 - 用户: {user_id}")
+                    logger.info("Coze 工作流执行成功 - 用户: %s", user_id)
                     # 工作流可能有不同的使用量统计方式
                     workflow_usage = getattr(workflow, 'usage', None)
                     if workflow_usage:
-                        logger.debug(f"工作流资源使用量: {workflow_usage}")
+                        logger.debug("工作流资源使用量: %s", workflow_usage)
                     return reply_content.strip()
                 else:
                     logger.warning(f"Coze 工作流执行完成但无有效输出 - 用户: {user_id}")
-                    return "抱歉，我现在有点忙，稍后再聊吧。"
+                    raise PlatformReplyError("抱歉，我现在有点忙，稍后再聊吧。")
             else:
                 logger.warning(f"Coze 工作流执行失败，无返回结果 - 用户: {user_id}")
-                return "抱歉，对话处理超时，请稍后再试。"
+                raise PlatformReplyError("抱歉，对话处理超时，请稍后再试。")
             
+        except PlatformReplyError:
+            raise
         except Exception as e:
             try:
                 error_msg = str(e)
@@ -304,55 +448,47 @@ class CozePlatform(BasePlatform):
             if "validation error for Message" in error_msg:
                 logger.error(f"Coze 工作流验证错误 - 用户: {user_id}, 可能是API返回格式异常，原始错误: {error_msg}")
                 logger.error(f"workflow内容: {repr(locals().get('workflow', None))}")
-                logger.error(f"Coze工作流请求参数: workflow_id={self.config['bot_id']}, user_id={user_id}, parameters={parameters}")
-                return "对不起，现在还不行哦"
+                logger.error(f"Coze工作流请求参数: workflow_id={self._bot_id}, user_id={user_id}, parameters={parameters}")
+                raise PlatformReplyError("对不起，现在还不行哦") from e
             else:
                 logger.error(f"Coze API 调用失败 - 用户: {user_id}, 错误: {error_msg}", exc_info=True)
-                return self.handle_error(e, user_id)
+                raise PlatformReplyError(self.handle_error(e, user_id)) from e
     
     def handle_error(self, error, user_id):
-        """处理错误"""
-        error_str = str(error).lower()
-        
-        if "authentication" in error_str or "authorization" in error_str or "401" in error_str:
-            logger.error(f"Coze 身份验证失败 - 用户: {user_id}")
-            return "抱歉，身份验证失败，请检查配置。"
-        elif "rate limit" in error_str or "429" in error_str:
-            logger.error(f"Coze 访问频率限制 - 用户: {user_id}")
-            return "抱歉，访问频率过高，请稍后再试。"
-        elif "quota" in error_str or "insufficient" in error_str:
-            logger.error(f"Coze 配额已用完 - 用户: {user_id}")
-            return "抱歉，配额已用完，请联系管理员。"
-        elif "timeout" in error_str:
-            logger.error(f"Coze 请求超时 - 用户: {user_id}")
-            return "抱歉，请求超时，请稍后再试。"
-        elif "network" in error_str or "connection" in error_str:
-            logger.error(f"Coze 网络连接失败 - 用户: {user_id}")
-            return "抱歉，网络连接失败，请稍后再试。"
-        else:
-            logger.error(f"Coze 未知错误 - 用户: {user_id}, 错误: {error}")
+        """处理错误（单次正则扫描，按规则表优先级分类）"""
+        matched = _classify_coze_error(str(error))
+        if matched is None:
+            logger.error("Coze 未知错误 - 用户: %s, 错误: %s", user_id, error)
             return "抱歉，服务暂时不可用，请稍后再试。"
+        
+        description, reply = matched
+        logger.error("%s - 用户: %s", description, user_id)
+        return reply
     
     def load_token_from_config(self):
         """
-        从config.py文件加载token
+        加载持久化的token
+        
+        优先读取 .coze_token.json 中与当前凭据匹配的条目，
+        没有时读取 COZE_CONFIG（兼容写在config.py中的旧token，仅当其凭据与实例一致）
         """
         try:
-            import sys
-            import os
-            
-            # 获取config模块
-            sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-            import config
-            
-            if not hasattr(config, 'COZE_CONFIG'):
-                return None
-            
-            current_token = config.COZE_CONFIG.get('current_token')
-            expires_at = config.COZE_CONFIG.get('token_expires_at')
+            saved = None
+            if os.path.exists(_TOKEN_FILE):
+                with open(_TOKEN_FILE, 'r', encoding='utf-8') as f:
+                    saved = json.load(f).get(self._token_file_key())
+                if saved is None:
+                    logger.debug(".coze_token.json 中没有与当前凭据匹配的token，已忽略")
+            if saved is None:
+                # config.py 中的旧token与 COZE_CONFIG 的凭据写在一起，实例使用同一应用时才可沿用
+                same_credential = all(self.config.get(key) == COZE_CONFIG.get(key) for key in ('client_id', 'public_key_id'))
+                saved = COZE_CONFIG if same_credential else {}
+            
+            current_token = saved.get('current_token')
+            expires_at = saved.get('token_expires_at')
             
             if not current_token or not expires_at:
-                logger.debug("config.py中未找到有效token信息")
+                logger.debug("未找到已保存的有效token信息")
                 return None
             
             current_time = time.time()
@@ -362,62 +498,44 @@ class CozePlatform(BasePlatform):
             
             # 检查token是否过期（使用配置的刷新阈值）
             if current_time < (expires_at - refresh_threshold):
-                remaining_hours = (expires_at - current_time) / 3600
-                logger.info(f"使用config.py中的缓存token，剩余有效期 {remaining_hours:.1f} 小时")
+                logger.info("使用已保存的缓存token，剩余有效期 %.1f 小时", (expires_at - current_time) / 3600)
                 
                 # 同时更新实例配置
                 self.config['token_expires_at'] = expires_at
                 
                 return current_token
             else:
-                logger.info(f"config.py中的token已过期或即将过期（剩余时间少于{refresh_threshold/60:.0f}分钟），将获取新token")
+                logger.info("已保存的token已过期或即将过期（剩余时间少于%.0f分钟），将获取新token", refresh_threshold / 60)
                 return None
                 
         except Exception as e:
-            logger.warning(f"从config.py加载token失败: {e}")
+            logger.warning(f"加载已保存的token失败: {e}")
             return None
 
     def save_token_to_config(self, token, expires_at):
         """
-        将token回写到config.py文件
+        将token按凭据保存到 .coze_token.json（先写临时文件再原子替换，保留其他凭据的条目）
         """
         try:
-            import os
-            import re
-            
-            # 获取config.py文件路径
-            project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            config_file = os.path.join(project_root, 'config.py')
-            
-            # 读取config.py文件
-            with open(config_file, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            # 更新current_token
-            token_pattern = r"'current_token':\s*[^,}]+"
-            new_token_line = f"'current_token': '{token}'"
-            content = re.sub(token_pattern, new_token_line, content)
-            
-            # 更新token_expires_at
-            expires_pattern = r"'token_expires_at':\s*[^,}]+"
-            new_expires_line = f"'token_expires_at': {expires_at}"
-            content = re.sub(expires_pattern, new_expires_line, content)
-            
-            # 写回文件
-            with open(config_file, 'w', encoding='utf-8') as f:
-                f.write(content)
-            
-            logger.info("Token 已成功回写到config.py文件")
-            
-            # 同时更新全局配置模块（避免需要重启）
-            import sys
-            sys.path.insert(0, project_root)
-            import config
-            if hasattr(config, 'COZE_CONFIG'):
-                config.COZE_CONFIG['current_token'] = token
-                config.COZE_CONFIG['token_expires_at'] = expires_at
+            with _token_file_lock:
+                saved = {}
+                if os.path.exists(_TOKEN_FILE):
+                    try:
+                        with open(_TOKEN_FILE, 'r', encoding='utf-8') as f:
+                            saved = json.load(f)
+                    except (OSError, ValueError):
+                        pass  # 文件损坏时整体重写
+                if not isinstance(saved, dict) or 'current_token' in saved:
+                    saved = {}  # 旧版本未按凭据区分的格式，无法确认归属，直接丢弃
+                saved[self._token_file_key()] = {'current_token': token, 'token_expires_at': expires_at}
+                temp_file = _TOKEN_FILE + ".tmp"
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    json.dump(saved, f)
+                os.replace(temp_file, _TOKEN_FILE)
+            
+            logger.info("Token 已成功保存到 .coze_token.json")
             
         except Exception as e:
-            logger.warning(f"回写token到config.py失败: {e}")
+            logger.warning(f"保存token失败: {e}")
     
  
\ No newline at end of file
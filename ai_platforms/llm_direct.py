@@ -1,36 +1,77 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import json
-import re
-from .base_platform import BasePlatform
-
-# 导入现有的配置
-try:
-    import sys
-    import os
-    # 添加项目根目录到路径
-    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import random
+import threading
+import time
+from functools import lru_cache
+from types import SimpleNamespace
+from openai import APIConnectionError, APIStatusError, InternalServerError, RateLimitError
+from .base_platform import BasePlatform, compile_error_classifier, dump_messages
+
+# 用到的配置项及导入失败时的默认值，避免程序崩溃
+_CONFIG_DEFAULTS = {
+    'DEEPSEEK_API_KEY': "",
+    'DEEPSEEK_BASE_URL': "",
+    'MODEL': "",
+    'TEMPERATURE': 1.1,
+    'MAX_TOKEN': 2000,
+    'MAX_GROUPS': 5,
+    'ENABLE_SENSITIVE_CONTENT_CLEARING': False,
+    'MAX_INFLIGHT_LLM_REQUESTS': 4,
+    'LLM_INFLIGHT_WAIT_TIMEOUT': 60,
+}
+
+@lru_cache(maxsize=None)
+def _cfg():
+    """延迟导入现有的配置（首次使用时导入一次，项目根目录已在运行 bot.py 时位于导入路径中）"""
+    try:
+        import config
+    except ImportError as e:
+        logging.error(f"Failed to import required modules: {e}")
+        config = None
+    return SimpleNamespace(**{name: getattr(config, name, default) for name, default in _CONFIG_DEFAULTS.items()})
+
+logger = logging.getLogger(__name__)
+
+@lru_cache(maxsize=None)
+def _llm_inflight():
+    """
+    同时进行中的大模型请求上限（MAX_INFLIGHT_LLM_REQUESTS，首次使用时按配置创建）
     
-    from config import (
-        DEEPSEEK_API_KEY, DEEPSEEK_BASE_URL, MODEL, 
-        TEMPERATURE, MAX_TOKEN, MAX_GROUPS,
-        ENABLE_SENSITIVE_CONTENT_CLEARING
-    )
+    多个用户同时触发时排队发送，避免一起撞上服务商的频率限制
+    """
+    return threading.BoundedSemaphore(max(1, int(_cfg().MAX_INFLIGHT_LLM_REQUESTS)))
+
+# 错误分类规则表：(关键词元组, (提示信息, 是否终止重试, 是否清除上下文))，按优先级排列；bot.py 的辅助模型重试也基于此表
+CHAT_API_ERROR_RULES = (
+    (("real name verification",), ("错误：API 服务商反馈请完成实名认证后再使用！", True, False)),
+    (("rate limit",), ("错误：API 服务商反馈当前访问 API 服务频次达到上限，请稍后再试！", False, False)),
+    (("payment required",), ("错误：API 服务商反馈您正在使用付费模型，请先充值再使用或使用免费额度模型！", True, False)),
+    (("user quota", "is not enough", "UnlimitedQuota"), ("错误：API 服务商反馈，你的余额不足，请先充值再使用! 如有余额，请检查令牌是否为无限额度。", True, False)),
+    (("Api key is invalid",), ("错误：API 服务商反馈 API KEY 不可用，请检查配置选项！", False, False)),
+    (("service unavailable",), ("错误：API 服务商反馈服务器繁忙，请稍后再试！", False, False)),
+    (("sensitive words detected",), ("错误：Prompt或消息中含有敏感词，无法生成回复，请联系API服务商！", True, True)),
+)
+_classify_chat_api_error = compile_error_classifier(CHAT_API_ERROR_RULES)
+
+# 重试前的最长等待时间（秒）
+MAX_RETRY_DELAY = 30
+
+def _retry_delay(attempt):
+    """
+    计算第 attempt 次失败后的重试等待时间（指数退避加随机抖动）
     
-    # 注意：bot模块的导入将在需要时进行，避免循环导入
-except ImportError as e:
-    logging.error(f"Failed to import required modules: {e}")
-    # 设置默认值，避免程序崩溃
-    DEEPSEEK_API_KEY = ""
-    DEEPSEEK_BASE_URL = ""
-    MODEL = ""
-    TEMPERATURE = 1.1
-    MAX_TOKEN = 2000
-    MAX_GROUPS = 5
-    ENABLE_SENSITIVE_CONTENT_CLEARING = False
+    HTTP 状态错误不会走到这里：429/5xx 已由 SDK 按 Retry-After 重试，4xx 直接终止
+    """
+    return min(MAX_RETRY_DELAY, 2 ** attempt) + random.random()
 
-logger = logging.getLogger(__name__)
+# 这些错误已由 OpenAI SDK 自身按指数退避重试过（见 bot.client 的 max_retries），无需再次重试
+_SDK_RETRIED_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+def _is_client_error(error):
+    """是否为 4xx 请求错误：参数、鉴权、余额等问题原样重试也不会成功（408/409/429 已由 SDK 重试过）"""
+    return isinstance(error, APIStatusError) and 400 <= error.status_code < 500
 
 class LLMDirectPlatform(BasePlatform):
     """
@@ -40,17 +81,20 @@ class LLMDirectPlatform(BasePlatform):
     复用基类的上下文管理机制。
     """
     
+    __slots__ = ()
+    
     def __init__(self, config=None):
         """初始化大模型直连平台"""
         # 使用现有配置
         if config is None:
+            cfg = _cfg()
             config = {
-                'api_key': DEEPSEEK_API_KEY,
-                'base_url': DEEPSEEK_BASE_URL,
-                'model': MODEL,
-                'temperature': TEMPERATURE,
-                'max_tokens': MAX_TOKEN,
-                'max_groups': MAX_GROUPS
+                'api_key': cfg.DEEPSEEK_API_KEY,
+                'base_url': cfg.DEEPSEEK_BASE_URL,
+                'model': cfg.MODEL,
+                'temperature': cfg.TEMPERATURE,
+                'max_tokens': cfg.MAX_TOKEN,
+                'max_groups': cfg.MAX_GROUPS
             }
         
         super().__init__(config)
@@ -88,14 +132,21 @@ class LLMDirectPlatform(BasePlatform):
         return call_chat_api_with_retry(messages, user_id, is_summary=is_summary)
 
 
+# 思考标签结束符，截取其后的内容；bot.py 的辅助模型回复也导入同一个函数处理
+_THOUGHT_END_TAGS = ('</thought>', '</think>')
+
 def strip_before_thought_tags(text):
     """去除思考标签前的内容"""
-    # 匹配并截取 </thought> 或 </think> 后面的内容
-    match = re.search(r'(?:</thought>|</think>)([\s\S]*)', text)
-    if match:
-        return match.group(1)
-    else:
+    # 截取最先出现的 </thought> 或 </think> 后面的内容（纯子串查找，不经过正则；大多数回复不含标签，两次查找后原样返回）
+    found = []
+    for tag in _THOUGHT_END_TAGS:
+        index = text.find(tag)
+        if index != -1:
+            found.append((index, tag))
+    if not found:
         return text
+    index, tag = min(found)
+    return text[index + len(tag):]
 
 def call_chat_api_with_retry(messages_to_send, user_id, max_retries=2, is_summary=False):
     """
@@ -110,22 +161,32 @@ def call_chat_api_with_retry(messages_to_send, user_id, max_retries=2, is_summar
     返回:
         str: API 返回的文本回复。
     """
+    cfg = _cfg()
+    model = cfg.MODEL
     attempt = 0
+    messages_dump = None  # 错误日志用的消息体，首次出错时才格式化，重试间复用
     while attempt <= max_retries:
         try:
-            logger.debug(f"发送给 API 的消息 (ID: {user_id}): {messages_to_send}")
+            logger.debug("发送给 API 的消息 (ID: %s): %s", user_id, messages_to_send)
 
             # 延迟导入避免循环依赖
             import bot
             client = bot.client
             
-            response = client.chat.completions.create(
-                model=MODEL,
-                messages=messages_to_send,
-                temperature=TEMPERATURE,
-                max_tokens=MAX_TOKEN,
-                stream=False
-            )
+            # 排队等待有限时间：卡住的请求占满名额时，按普通错误退避重试，而不是让所有调用无限期阻塞
+            inflight = _llm_inflight()
+            if not inflight.acquire(timeout=cfg.LLM_INFLIGHT_WAIT_TIMEOUT):
+                raise TimeoutError(f"等待大模型请求名额超时（{cfg.LLM_INFLIGHT_WAIT_TIMEOUT}秒），同时进行中的请求已达上限")
+            try:
+                response = client.chat.completions.create(
+                    model=model,
+                    messages=messages_to_send,
+                    temperature=cfg.TEMPERATURE,
+                    max_tokens=cfg.MAX_TOKEN,
+                    stream=False
+                )
+            finally:
+                inflight.release()
 
             if response.choices:
                 content = response.choices[0].message.content
@@ -137,48 +198,43 @@ def call_chat_api_with_retry(messages_to_send, user_id, max_retries=2, is_summar
                             return filtered_content
 
             # 记录错误日志
-            logger.error(f"错误请求消息体: {MODEL}")
-            logger.error(json.dumps(messages_to_send, ensure_ascii=False, indent=2))
-            logger.error(f"\033[31m错误：API 返回了空的选择项或内容为空。模型名:{MODEL}\033[0m")
+            logger.error(f"错误请求消息体: {model}")
+            if logger.isEnabledFor(logging.ERROR):
+                messages_dump = messages_dump or dump_messages(messages_to_send)
+                logger.error(messages_dump)
+            logger.error(f"\033[31m错误：API 返回了空的选择项或内容为空。模型名:{model}\033[0m")
             logger.error(f"完整响应对象: {response}")
 
         except Exception as e:
-            logger.error(f"错误请求消息体: {MODEL}")
-            logger.error(json.dumps(messages_to_send, ensure_ascii=False, indent=2))
+            logger.error(f"错误请求消息体: {model}")
+            if logger.isEnabledFor(logging.ERROR):
+                messages_dump = messages_dump or dump_messages(messages_to_send)
+                logger.error(messages_dump)
             error_info = str(e)
-            logger.error(f"自动重试：第 {attempt + 1} 次调用 {MODEL}失败 (ID: {user_id}) 原因: {error_info}", exc_info=False)
-
-            # 细化错误分类
-            if "real name verification" in error_info:
-                logger.error("\033[31m错误：API 服务商反馈请完成实名认证后再使用！\033[0m")
-                break  # 终止循环，不再重试
-            elif "rate limit" in error_info:
-                logger.error("\033[31m错误：API 服务商反馈当前访问 API 服务频次达到上限，请稍后再试！\033[0m")
-            elif "payment required" in error_info:
-                logger.error("\033[31m错误：API 服务商反馈您正在使用付费模型，请先充值再使用或使用免费额度模型！\033[0m")
-                break  # 终止循环，不再重试
-            elif "user quota" in error_info or "is not enough" in error_info or "UnlimitedQuota" in error_info:
-                logger.error("\033[31m错误：API 服务商反馈，你的余额不足，请先充值再使用! 如有余额，请检查令牌是否为无限额度。\033[0m")
-                break  # 终止循环，不再重试
-            elif "Api key is invalid" in error_info:
-                logger.error("\033[31m错误：API 服务商反馈 API KEY 不可用，请检查配置选项！\033[0m")
-            elif "service unavailable" in error_info:
-                logger.error("\033[31m错误：API 服务商反馈服务器繁忙，请稍后再试！\033[0m")
-            elif "sensitive words detected" in error_info:
-                logger.error("\033[31m错误：Prompt或消息中含有敏感词，无法生成回复，请联系API服务商！\033[0m")
-                if ENABLE_SENSITIVE_CONTENT_CLEARING:
+            logger.error(f"自动重试：第 {attempt + 1} 次调用 {model}失败 (ID: {user_id}) 原因: {error_info}", exc_info=False)
+
+            # 细化错误分类（单次扫描，按规则表优先级取结果）
+            matched = _classify_chat_api_error(error_info)
+            if matched is None:
+                logger.error("\033[31m未知错误：" + error_info + "\033[0m")
+                stop_retry = False
+            else:
+                message, stop_retry, clear_context = matched
+                logger.error(f"\033[31m{message}\033[0m")
+                if clear_context and cfg.ENABLE_SENSITIVE_CONTENT_CLEARING:
                     logger.warning(f"已开启敏感词自动清除上下文功能，开始清除用户 {user_id} 的聊天上下文")
                     # 延迟导入避免循环依赖
                     import bot
-                    clear_chat_context = bot.clear_chat_context
-                    clear_memory_temp_files = bot.clear_memory_temp_files
-                    clear_chat_context(user_id)
+                    bot.clear_chat_context(user_id)
                     if is_summary:
-                        clear_memory_temp_files(user_id)  # 如果是总结任务，清除临时文件
-                break  # 终止循环，不再重试
-            else:
-                logger.error("\033[31m未知错误：" + error_info + "\033[0m")
+                        bot.clear_memory_temp_files(user_id)  # 如果是总结任务，清除临时文件
+
+            if stop_retry or isinstance(e, _SDK_RETRIED_ERRORS) or _is_client_error(e):
+                break  # 终止循环，不再重试（SDK 已重试过的错误和 4xx 请求错误同样不再重复）
 
+        if attempt < max_retries:
+            # 退避后再重试，避免立即重复请求加重服务端压力
+            time.sleep(_retry_delay(attempt))
         attempt += 1
 
     raise RuntimeError("抱歉，我现在有点忙，稍后再聊吧。")
@@ -13,6 +13,9 @@ from . import PlatformRouter, BasePlatform
 
 logger = logging.getLogger(__name__)
 
+# LISTEN_LIST 中允许使用的平台名称
+_VALID_PLATFORMS = frozenset(('llm_direct', 'coze', 'dify'))
+
 def parse_listen_list(listen_list: List[List[str]]) -> Dict[str, Dict[str, str]]:
     """
     解析监听列表，提取平台配置
@@ -40,9 +43,8 @@ def parse_listen_list(listen_list: List[List[str]]) -> Dict[str, Dict[str, str]]
             username, role, platform = entry
             
             # 验证平台名称
-            valid_platforms = ['llm_direct', 'coze', 'dify']
-            if platform not in valid_platforms:
-                raise ValueError(f"Invalid platform '{platform}' for user {username}. Valid platforms: {valid_platforms}")
+            if platform not in _VALID_PLATFORMS:
+                raise ValueError(f"Invalid platform '{platform}' for user {username}. Valid platforms: {sorted(_VALID_PLATFORMS)}")
             
             # 检查用户名是否重复
             if username in user_platform_mapping:
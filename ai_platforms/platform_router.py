@@ -1,12 +1,24 @@
 # -*- coding: utf-8 -*-
 
+import importlib
 import logging
+import os
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from typing import Dict, Optional, Any
 from .base_platform import BasePlatform
 from .llm_direct import LLMDirectPlatform
 
 logger = logging.getLogger(__name__)
 
+# 项目根目录（config.py 所在目录），只在不存在时加入导入路径
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, _PROJECT_ROOT)
+
 class PlatformRouter:
     """
     AI平台路由器
@@ -15,6 +27,13 @@ class PlatformRouter:
     并提供统一的消息路由接口。
     """
     
+    # 实例属性固定，使用 __slots__ 省去实例的 __dict__
+    __slots__ = (
+        'user_platform_mapping', 'platform_instances', 'default_platform',
+        '_default_config', '_user_platform_names', '_user_distribution', '_user_platform_cache',
+        '_platform_classes', '_platform_lock',
+    )
+    
     def __init__(self, user_platform_mapping: Dict[str, Dict[str, str]]):
         """
         初始化平台路由器
@@ -26,42 +45,88 @@ class PlatformRouter:
         self.user_platform_mapping = user_platform_mapping
         self.platform_instances: Dict[str, BasePlatform] = {}
         self.default_platform = 'llm_direct'
+        # 未配置用户共用的只读默认配置
+        self._default_config = MappingProxyType({'role': 'default', 'platform': self.default_platform})
+        self._user_platform_names = self._resolve_platform_names(user_platform_mapping)
+        self._user_distribution = Counter(self._user_platform_names.values())  # 各平台用户数，映射更新时重算
+        self._user_platform_cache: Dict[str, BasePlatform] = {}  # 用户已解析出的平台实例，映射或平台变化时整体换成新字典
         
-        # 初始化所有平台
+        # 平台实例在首次使用时才创建，这里只登记可用的平台类
+        self._platform_classes: Dict[str, Any] = {}
+        self._platform_lock = threading.Lock()
         self._init_platforms()
         
-        logger.info(f"平台路由器初始化完成，共 {len(self.platform_instances)} 个平台")
+        logger.info(f"平台路由器初始化完成，共 {len(self._platform_classes)} 个平台")
         logger.info(f"用户映射包含 {len(user_platform_mapping)} 个用户")
     
     def _init_platforms(self):
-        """初始化所有平台实例"""
+        """登记所有可用的平台类（实例由 _get_platform 按需创建）"""
         # 平台类映射
-        platform_classes: Dict[str, Any] = {
-            'llm_direct': LLMDirectPlatform,
-        }
+        platform_classes = self._platform_classes
+        platform_classes['llm_direct'] = LLMDirectPlatform
         
-        # 延迟导入其他平台，避免循环依赖
-        try:
-            from .coze_platform import CozePlatform
-            platform_classes['coze'] = CozePlatform
-        except Exception as e:
-            logger.warning(f"Coze 平台不可用: {e}")
+        # 其他平台只登记 (模块名, 类名)，首次路由到该平台时才导入，
+        # 避免循环依赖，也避免没有用户使用时导入其SDK（如 cozepy）
+        platform_classes['coze'] = ('.coze_platform', 'CozePlatform')
         
         # Dify平台暂未实现
-        # try:
-        #     from .dify_platform import DifyPlatform
-        #     platform_classes['dify'] = DifyPlatform
-        # except Exception as e:
-        #     logger.warning(f"Dify 平台不可用: {e}")
-        
-        # 初始化各平台实例
-        for platform_name, platform_class in platform_classes.items():
-            try:
-                self.platform_instances[platform_name] = platform_class()
-                logger.info(f"成功初始化 {platform_name} 平台")
-            except Exception as e:
-                logger.error(f"初始化 {platform_name} 平台失败: {e}")
-                # 直接跳过失败的平台，不使用降级
+        # platform_classes['dify'] = ('.dify_platform', 'DifyPlatform')
+    
+    def _get_platform(self, platform_name: str) -> Optional[BasePlatform]:
+        """
+        获取平台实例，首次使用时创建（线程安全，每个平台只创建一次）
+        
+        Args:
+            platform_name (str): 平台名称
+        
+        Returns:
+            BasePlatform: 平台实例，平台不存在或初始化失败时返回None
+        """
+        platform = self.platform_instances.get(platform_name)
+        if platform is not None:
+            return platform
+        
+        with self._platform_lock:
+            platform = self.platform_instances.get(platform_name)
+            if platform is None and platform_name in self._platform_classes:
+                platform_class = self._platform_classes[platform_name]
+                try:
+                    if isinstance(platform_class, tuple):
+                        module_name, class_name = platform_class
+                        platform_class = getattr(importlib.import_module(module_name, __package__), class_name)
+                    platform = self.platform_instances[platform_name] = platform_class()
+                    logger.info(f"成功初始化 {platform_name} 平台")
+                except Exception as e:
+                    logger.error(f"初始化 {platform_name} 平台失败: {e}")
+                    # 直接跳过失败的平台，不使用降级，之后也不再重试
+                    del self._platform_classes[platform_name]
+        return platform
+    
+    def _get_all_platforms(self) -> Dict[str, BasePlatform]:
+        """创建所有尚未使用过的平台实例，返回全部可用平台（用于统计和连接测试）"""
+        for platform_name in list(self._platform_classes):
+            self._get_platform(platform_name)
+        return dict(self.platform_instances)
+    
+    def _resolve_platform_names(self, user_platform_mapping: Dict[str, Dict[str, str]]) -> Dict[str, str]:
+        """
+        预先解析每个用户使用的平台名称，路由时只需一次字典查找
+        
+        同时补全映射中缺少的 role/platform 字段，之后可直接用 config['platform'] 取值
+        
+        Args:
+            user_platform_mapping (dict): 用户平台映射配置
+        
+        Returns:
+            dict: {user_id: platform_name}
+        """
+        for config in user_platform_mapping.values():
+            config.setdefault('role', 'default')
+            config.setdefault('platform', self.default_platform)
+        return {
+            sys.intern(user_id): config['platform']
+            for user_id, config in user_platform_mapping.items()
+        }
     
     def get_user_platform(self, user_id: str) -> Optional[BasePlatform]:
         """
@@ -73,18 +138,26 @@ class PlatformRouter:
         Returns:
             BasePlatform: 平台实例，如果找不到则返回默认平台
         """
-        # 获取用户配置的平台
-        user_config = self.user_platform_mapping.get(user_id, {})
-        platform_name = user_config.get('platform', self.default_platform)
+        # 先取缓存再取映射表（更新时顺序相反）：并发更新映射或平台时，
+        # 本次解析结果只会写进已被替换的旧缓存，新缓存中不会留下过期的平台实例
+        cache = self._user_platform_cache
+        platform = cache.get(user_id)
+        if platform is not None:
+            return platform
         
-        # 获取平台实例
-        platform = self.platform_instances.get(platform_name)
+        # 获取用户配置的平台（映射更新时已解析好）
+        platform_name = self._user_platform_names.get(user_id, self.default_platform)
+        
+        # 获取平台实例（首次使用时创建）
+        platform = self._get_platform(platform_name)
         
         if not platform:
             logger.error(f"用户 {user_id} 配置的平台 {platform_name} 不可用")
             return None
         
-        logger.debug(f"为用户 {user_id} 选择平台 {platform.get_platform_name()}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"为用户 {user_id} 选择平台 {platform.get_platform_name()}")
+        cache[user_id] = platform
         return platform
     
     def route_message(self, user_id: str, message: str, store_context: bool = True, is_summary: bool = False, system_prompt: Optional[str] = None) -> str:
@@ -106,11 +179,10 @@ class PlatformRouter:
             return "抱歉，AI服务暂时不可用。"
         
         try:
-            logger.info(f"将用户 {user_id} 的消息路由到 {platform.get_platform_name()}")
-            logger.info(f"message: {message}")
-            logger.info(f"store_context: {store_context}")
-            logger.info(f"is_summary: {is_summary}")
-            logger.info(f"system_prompt: {system_prompt}")
+            logger.info("将用户 %s 的消息路由到 %s", user_id, platform.get_platform_name())
+            # 消息和提示词可能很长，仅在 DEBUG 级别输出
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("message: %s, store_context: %s, is_summary: %s, system_prompt: %s", message, store_context, is_summary, system_prompt)
             response = platform.get_response(
                 message, 
                 user_id, 
@@ -132,12 +204,9 @@ class PlatformRouter:
             user_id (str): 用户ID
         
         Returns:
-            dict: 用户配置字典，包含role和platform
+            dict: 用户配置字典，包含role和platform（未配置的用户返回只读的默认配置）
         """
-        return self.user_platform_mapping.get(user_id, {
-            'role': 'default',
-            'platform': self.default_platform
-        })
+        return self.user_platform_mapping.get(user_id, self._default_config)
     
     def get_platform_stats(self) -> Dict[str, Any]:
         """
@@ -146,15 +215,16 @@ class PlatformRouter:
         Returns:
             dict: 包含各平台状态的统计信息
         """
+        platform_instances = self._get_all_platforms()
         stats = {
-            'total_platforms': len(self.platform_instances),
+            'total_platforms': len(platform_instances),
             'available_platforms': [],
             'user_distribution': {},
             'default_platform': self.default_platform
         }
         
         # 统计可用平台
-        for name, platform in self.platform_instances.items():
+        for name, platform in platform_instances.items():
             if platform:
                 stats['available_platforms'].append({
                     'name': name,
@@ -162,12 +232,8 @@ class PlatformRouter:
                     'info': platform.get_platform_info()
                 })
         
-        # 统计用户分布
-        for user_id, config in self.user_platform_mapping.items():
-            platform_name = config.get('platform', self.default_platform)
-            if platform_name not in stats['user_distribution']:
-                stats['user_distribution'][platform_name] = 0
-            stats['user_distribution'][platform_name] += 1
+        # 统计用户分布（映射更新时已统计好）
+        stats['user_distribution'] = dict(self._user_distribution)
         
         return stats
     
@@ -175,20 +241,25 @@ class PlatformRouter:
         """
         测试所有平台连接状态
         
+        各平台并行测试，总耗时取决于最慢的平台
+        
         Returns:
             dict: 各平台的连接测试结果
         """
-        results = {}
-        for name, platform in self.platform_instances.items():
-            if platform:
+        platform_instances = self._get_all_platforms()
+        results = {name: False for name in platform_instances}
+        platforms_to_test = {name: platform for name, platform in platform_instances.items() if platform}
+        if not platforms_to_test:
+            return results
+        
+        with ThreadPoolExecutor(max_workers=len(platforms_to_test), thread_name_prefix="platform-test") as executor:
+            futures = {name: executor.submit(platform.test_connection) for name, platform in platforms_to_test.items()}
+            for name, future in futures.items():
                 try:
-                    results[name] = platform.test_connection()
+                    results[name] = future.result()
                     logger.info(f"平台 {name} 连接测试: {'通过' if results[name] else '失败'}")
                 except Exception as e:
-                    results[name] = False
                     logger.error(f"平台 {name} 连接测试失败: {e}")
-            else:
-                results[name] = False
         
         return results
     
@@ -199,7 +270,10 @@ class PlatformRouter:
         Args:
             user_platform_mapping (dict): 新的用户平台映射配置
         """
+        self._user_platform_names = self._resolve_platform_names(user_platform_mapping)
+        self._user_distribution = Counter(self._user_platform_names.values())
         self.user_platform_mapping = user_platform_mapping
+        self._user_platform_cache = {}  # 映射表换好之后再换缓存，不在旧字典上 clear()
         logger.info(f"已更新 {len(user_platform_mapping)} 个用户的平台映射")
     
     def add_platform(self, name: str, platform_class, config=None):
@@ -212,7 +286,11 @@ class PlatformRouter:
             config (dict, optional): 平台配置
         """
         try:
-            self.platform_instances[name] = platform_class(config)
+            platform = platform_class(config)
+            with self._platform_lock:
+                self._platform_classes[name] = platform_class
+                self.platform_instances[name] = platform
+            self._user_platform_cache = {}
             logger.info(f"成功添加平台: {name}")
         except Exception as e:
             logger.error(f"添加平台 {name} 失败: {e}")
@@ -221,39 +299,34 @@ class PlatformRouter:
 
 # 全局路由器实例
 _global_router: Optional[PlatformRouter] = None
+_global_router_lock = threading.Lock()
 
 
-def _load_user_platform_mapping():
+def _load_user_platform_mapping(reload_config=False):
     """
     从配置文件加载用户平台映射
     
+    Args:
+        reload_config (bool): 是否重新执行配置文件以读取最新的 LISTEN_LIST
+    
     Returns:
         dict: 用户平台映射字典
     """
     try:
         # 导入配置
-        import sys
-        import os
-        # 添加项目根目录到路径
-        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-        
-        from config import LISTEN_LIST
-        
-        # 转换LISTEN_LIST为字典格式
-        user_mapping = {}
-        for entry in LISTEN_LIST:
-            if len(entry) >= 3:
-                user_id, role, platform = entry[0], entry[1], entry[2]
-                user_mapping[user_id] = {
-                    'role': role,
-                    'platform': platform
-                }
-            elif len(entry) >= 2:
-                user_id, role = entry[0], entry[1]
-                user_mapping[user_id] = {
-                    'role': role,
-                    'platform': 'llm_direct'  # 默认平台
-                }
+        import config
+        if reload_config:
+            config = importlib.reload(config)
+        
+        # 转换LISTEN_LIST为字典格式，缺少平台时使用默认平台
+        user_mapping = {
+            entry[0]: {
+                'role': sys.intern(entry[1]),
+                'platform': sys.intern(entry[2]) if len(entry) >= 3 else 'llm_direct'
+            }
+            for entry in config.LISTEN_LIST
+            if len(entry) >= 2
+        }
         
         logger.info(f"已加载 {len(user_mapping)} 个用户的平台映射")
         return user_mapping
@@ -272,12 +345,17 @@ def _get_global_router() -> PlatformRouter:
     """
     global _global_router
     
-    if _global_router is None:
-        user_mapping = _load_user_platform_mapping()
-        _global_router = PlatformRouter(user_mapping)
-        logger.info("全局平台路由器初始化完成")
+    # 已初始化时只需一次读取，无需加锁
+    router = _global_router
+    if router is not None:
+        return router
     
-    return _global_router
+    with _global_router_lock:
+        if _global_router is None:
+            user_mapping = _load_user_platform_mapping()
+            _global_router = PlatformRouter(user_mapping)
+            logger.info("全局平台路由器初始化完成")
+        return _global_router
 
 
 def get_platform_response(message: str, user_id: str, store_context: bool = True, is_summary: bool = False, system_prompt: Optional[str] = None) -> str:
@@ -295,7 +373,8 @@ def get_platform_response(message: str, user_id: str, store_context: bool = True
         str: AI回复
     """
     try:
-        router = _get_global_router()
+        # 路由器初始化后直接读取全局实例，省去一层函数调用
+        router = _global_router or _get_global_router()
         return router.route_message(
             user_id, 
             message, 
@@ -344,14 +423,15 @@ def reload_user_mapping():
     """
     global _global_router
     try:
-        user_mapping = _load_user_platform_mapping()
-        if _global_router:
-            _global_router.update_user_mapping(user_mapping)
-            logger.info("用户平台映射重新加载完成")
-        else:
-            # 如果路由器未初始化，创建新的
-            _global_router = PlatformRouter(user_mapping)
-            logger.info("创建全局平台路由器，使用新的映射配置")
+        user_mapping = _load_user_platform_mapping(reload_config=True)
+        with _global_router_lock:
+            if _global_router:
+                _global_router.update_user_mapping(user_mapping)
+                logger.info("用户平台映射重新加载完成")
+            else:
+                # 如果路由器未初始化，创建新的
+                _global_router = PlatformRouter(user_mapping)
+                logger.info("创建全局平台路由器，使用新的映射配置")
     except Exception as e:
         logger.error(f"重新加载用户映射失败: {e}")
         raise 
\ No newline at end of file
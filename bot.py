@@ -11,6 +11,9 @@
 # ***********************************************************************
 
 import sys
+# 以脚本方式运行时模块名为 __main__，注册为 bot 以便 ai_platforms 中的 `import bot`
+# 拿到同一份模块，而不是重新执行 bot.py 生成第二份全局状态（上下文、锁、客户端等）
+sys.modules.setdefault('bot', sys.modules[__name__])
 import base64
 import requests
 import logging
@@ -19,7 +22,8 @@ import datetime as dt
 import threading
 import time
 from wxautox_wechatbot import WeChat
-from openai import OpenAI
+from openai import OpenAI, DefaultHttpxClient
+import httpx
 import random
 from typing import Optional
 import pyautogui
@@ -29,6 +33,8 @@ from config import *
 import queue
 import json
 from threading import Timer
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse
 import os
@@ -40,6 +46,14 @@ WxParam.FORCE_MESSAGE_XBIAS = True
 # 数据库相关导入
 from database import db_manager, init_database, close_database
 from database import UserChatMessage, GroupChatMessage, GroupSummary
+from ai_platforms.base_platform import compile_error_classifier, dump_messages  # 仅依赖标准库，不会循环导入 bot
+from ai_platforms.llm_direct import CHAT_API_ERROR_RULES, strip_before_thought_tags  # 模块导入时不会导入 bot
+
+# orjson 可选，读写聊天上下文文件比标准库 json 快数倍；未安装时回退到 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # 生成用户昵称列表和prompt映射字典  
 user_names = [entry[0] for entry in LISTEN_LIST]
@@ -61,8 +75,22 @@ root_dir = os.path.dirname(os.path.abspath(__file__))
 # 用户消息队列和聊天上下文管理
 user_queues = {}  # {user_id: {'messages': [], 'last_message_time': 时间戳, ...}}
 queue_lock = threading.Lock()  # 队列访问锁
-chat_contexts = {}  # {user_id: [{'role': 'user', 'content': '...'}, ...]}
+CHAT_CONTEXT_LIMIT = MAX_GROUPS * 2  # 每个用户保留的上下文消息条数（deque 自动淘汰最旧的消息）
+CHAT_CONTEXT_CHAR_BUDGET = 16000  # 每次请求携带的历史消息总字符数上限（含当前消息），超出时从最旧的消息开始省略
+
+def new_chat_context(messages=()):
+    """创建单个用户的定长上下文，追加时自动裁剪历史记录。"""
+    return deque(messages, maxlen=CHAT_CONTEXT_LIMIT)
+
+chat_contexts = defaultdict(new_chat_context)  # {user_id: deque([{'role': 'user', 'content': '...'}, ...], maxlen=CHAT_CONTEXT_LIMIT)}，首次访问时自动创建
 CHAT_CONTEXTS_FILE = "chat_contexts.json" # 存储聊天上下文的文件名
+CHAT_CONTEXTS_FLUSH_DELAY = 0.5  # 上下文写盘前的合并等待时间（秒）
+chat_contexts_dirty = threading.Event()  # 上下文存在尚未写盘的修改
+chat_contexts_dirty_users = set()  # 有尚未写盘修改的用户（受 queue_lock 保护），重新加载文件时保留其内存中的上下文
+chat_contexts_file_lock = threading.Lock()  # 上下文文件读写锁；需要同时持有 queue_lock 时必须先获取本锁
+chat_contexts_mtime = None  # 最近一次加载/保存后上下文文件的修改时间，用于检测外部修改（受 chat_contexts_file_lock 保护）
+chat_contexts_flusher_thread = None  # 上下文后台写盘线程
+chat_contexts_flusher_lock = threading.Lock()  # 保证后台写盘线程只启动一次
 USER_TIMERS_FILE = "user_timers.json"  # 存储用户计时器状态的文件名
 
 # 心跳相关全局变量
@@ -353,15 +381,36 @@ emoji_timer_lock = threading.Lock()
 # 全局变量，控制消息发送状态
 can_send_messages = True
 is_sending_message = False
+# 微信界面自动化不能并发操作，所有发送都经由这把锁串行执行
+wx_send_lock = threading.Lock()
+
+# 各用户的消息处理（含LLM/Coze调用）在线程池中并发执行，一个用户的慢请求不再阻塞其他用户
+MAX_MESSAGE_WORKERS = 8
+message_worker_pool = ThreadPoolExecutor(max_workers=MAX_MESSAGE_WORKERS, thread_name_prefix="UserMessageWorker")
+# 正在处理中的用户，同一用户的消息按顺序处理，由 processing_users_lock 保护
+processing_users = set()
+processing_users_lock = threading.Lock()
 
 # --- 定时重启相关全局变量 ---
 program_start_time = 0.0 # 程序启动时间戳
 last_received_message_timestamp = 0.0 # 最后一次活动（收到/处理消息）的时间戳
 
+# 各 OpenAI 客户端共用一个 HTTP 连接池并保持长连接（SDK 默认为每个客户端各建一个）
+# 不启用 HTTP/2：需要额外安装 h2
+# 聊天消息间隔通常较长，空闲连接保留90秒（httpx 默认仅5秒），减少重复的 TCP/TLS 握手
+llm_http_client = DefaultHttpxClient(
+    limits=httpx.Limits(max_keepalive_connections=64, max_connections=128, keepalive_expiry=90)
+)
+
 # 初始化OpenAI客户端
+# 连接错误、超时、429和5xx由SDK按指数退避重试，调用方不再对这些错误重复重试
+# 超时沿用SDK默认值：读取超时较长（推理模型可能思考很久），建立连接超时仅5秒，连接失败时已能尽快交给重试
+LLM_API_MAX_RETRIES = 2
 client = OpenAI(
     api_key=DEEPSEEK_API_KEY,
-    base_url=DEEPSEEK_BASE_URL
+    base_url=DEEPSEEK_BASE_URL,
+    max_retries=LLM_API_MAX_RETRIES,
+    http_client=llm_http_client
 )
 
 #初始化在线 AI 客户端 (如果启用)
@@ -370,7 +419,8 @@ if ENABLE_ONLINE_API:
     try:
         online_client = OpenAI(
             api_key=ONLINE_API_KEY,
-            base_url=ONLINE_BASE_URL
+            base_url=ONLINE_BASE_URL,
+            http_client=llm_http_client
         )
         logger.info("联网搜索 API 客户端已初始化。")
     except Exception as e:
@@ -384,7 +434,8 @@ if ENABLE_ASSISTANT_MODEL:
     try:
         assistant_client = OpenAI(
             api_key=ASSISTANT_API_KEY,
-            base_url=ASSISTANT_BASE_URL
+            base_url=ASSISTANT_BASE_URL,
+            http_client=llm_http_client
         )
         logger.info("辅助模型 API 客户端已初始化。")
     except Exception as e:
@@ -540,11 +591,16 @@ def on_user_message(user):
         user_names.append(user)
     reset_user_timer(user)
 
+def get_user_prompt_path(user_id):
+    """获取用户对应的Prompt文件路径"""
+    # 查找映射中的文件名，若不存在则使用user_id
+    prompt_file = prompt_mapping.get(user_id, user_id)
+    return os.path.join(root_dir, 'prompts', f'{prompt_file}.md')
+
 # 修改get_user_prompt函数
 def get_user_prompt(user_id):
-    # 查找映射中的文件名，若不存在则使用user_id
     prompt_file = prompt_mapping.get(user_id, user_id)
-    prompt_path = os.path.join(root_dir, 'prompts', f'{prompt_file}.md')
+    prompt_path = get_user_prompt_path(user_id)
     
     if not os.path.exists(prompt_path):
         logger.error(f"Prompt文件不存在: {prompt_path}")
@@ -560,46 +616,111 @@ def get_user_prompt(user_id):
                 prompt_content = prompt_content.split(memory_marker, 1)[0].strip()
             return prompt_content
              
-# 加载聊天上下文
-def load_chat_contexts():
-    """从文件加载聊天上下文。"""
-    global chat_contexts # 声明我们要修改全局变量
+def get_chat_contexts_mtime():
+    """获取上下文文件的修改时间，文件不存在时返回 None。"""
+    try:
+        return os.stat(CHAT_CONTEXTS_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+def read_chat_contexts_file():
+    """读取上下文文件并转换为定长 deque（调用方应持有 chat_contexts_file_lock），出错时返回空上下文。"""
     try:
         if os.path.exists(CHAT_CONTEXTS_FILE):
-            with open(CHAT_CONTEXTS_FILE, 'r', encoding='utf-8') as f:
-                loaded_contexts = json.load(f)
-                if isinstance(loaded_contexts, dict):
-                    chat_contexts = loaded_contexts
-                    logger.info(f"成功从 {CHAT_CONTEXTS_FILE} 加载 {len(chat_contexts)} 个用户的聊天上下文。")
-                else:
-                    logger.warning(f"{CHAT_CONTEXTS_FILE} 文件内容格式不正确（非字典），将使用空上下文。")
-                    chat_contexts = {} # 重置为空
+            if orjson is not None:
+                with open(CHAT_CONTEXTS_FILE, 'rb') as f:
+                    loaded_contexts = orjson.loads(f.read()) # orjson.JSONDecodeError 是 json.JSONDecodeError 的子类
+            else:
+                with open(CHAT_CONTEXTS_FILE, 'r', encoding='utf-8') as f:
+                    loaded_contexts = json.load(f)
+            if isinstance(loaded_contexts, dict):
+                # 转换为定长 deque，追加时自动裁剪历史记录
+                contexts = defaultdict(new_chat_context, {
+                    user_id: new_chat_context(messages)
+                    for user_id, messages in loaded_contexts.items()
+                })
+                logger.info(f"成功从 {CHAT_CONTEXTS_FILE} 加载 {len(contexts)} 个用户的聊天上下文。")
+                return contexts
+            logger.warning(f"{CHAT_CONTEXTS_FILE} 文件内容格式不正确（非字典），将使用空上下文。")
         else:
             logger.info(f"{CHAT_CONTEXTS_FILE} 未找到，将使用空聊天上下文启动。")
-            chat_contexts = {} # 初始化为空
     except json.JSONDecodeError:
         logger.error(f"解析 {CHAT_CONTEXTS_FILE} 失败，文件可能已损坏。将使用空上下文。")
         # 可以考虑在这里备份损坏的文件
         # shutil.copy(CHAT_CONTEXTS_FILE, CHAT_CONTEXTS_FILE + ".corrupted")
-        chat_contexts = {} # 重置为空
     except Exception as e:
-        logger.error(f"加载聊天上下文失败: {e}", exc_info=True)
-        chat_contexts = {} # 出现其他错误也重置为空，保证程序能启动
+        logger.error(f"加载聊天上下文失败: {e}", exc_info=True) # 出现其他错误也使用空上下文，保证程序能启动
+    return defaultdict(new_chat_context)
+
+# 加载聊天上下文
+def load_chat_contexts():
+    """从文件加载聊天上下文，替换内存中的全部上下文。"""
+    global chat_contexts, chat_contexts_mtime # 声明我们要修改全局变量
+    with chat_contexts_file_lock:
+        mtime = get_chat_contexts_mtime() # 先取修改时间再读取，读取期间的修改会在下次检查时发现
+        loaded_contexts = read_chat_contexts_file()
+        with queue_lock:
+            chat_contexts = loaded_contexts
+            chat_contexts_dirty_users.clear()
+            chat_contexts_mtime = mtime
+
+def reload_chat_contexts_if_changed():
+    """
+    仅当上下文文件被外部修改（如配置编辑器清除了某个用户的上下文）时重新加载。
+
+    尚未写盘的用户保留内存中的上下文，其余用户以文件内容为准，合并结果由后台线程写回。
+    """
+    global chat_contexts, chat_contexts_mtime
+    if get_chat_contexts_mtime() == chat_contexts_mtime:
+        return
+    with chat_contexts_file_lock:
+        # 加锁后复查：本进程刚完成的写盘会在锁内更新 chat_contexts_mtime，不应视为外部修改
+        mtime = get_chat_contexts_mtime()
+        if mtime == chat_contexts_mtime:
+            return
+        logger.info(f"检测到 {CHAT_CONTEXTS_FILE} 已被外部修改，重新加载聊天上下文。")
+        loaded_contexts = read_chat_contexts_file()
+        with queue_lock:
+            for user_id in chat_contexts_dirty_users:
+                if user_id in chat_contexts:
+                    loaded_contexts[user_id] = chat_contexts[user_id]
+                else:
+                    loaded_contexts.pop(user_id, None) # 尚未写盘的清除操作
+            chat_contexts = loaded_contexts
+            chat_contexts_mtime = mtime
 
 # 保存聊天上下文
 def save_chat_contexts():
-    """将当前聊天上下文保存到文件。"""
-    global chat_contexts
+    """立即将当前聊天上下文保存到文件（调用方不能持有 queue_lock）。"""
+    with chat_contexts_file_lock:
+        chat_contexts_dirty.clear()
+        with queue_lock:
+            # 创建要保存的上下文副本，以防在写入时被其他线程修改
+            # deque 无法直接序列化为 JSON，转换为列表
+            contexts_to_save = {user_id: list(messages) for user_id, messages in chat_contexts.items()}
+            saved_users = set(chat_contexts_dirty_users)
+            chat_contexts_dirty_users.clear()
+        if not write_chat_contexts(contexts_to_save):
+            with queue_lock:
+                chat_contexts_dirty_users.update(saved_users) # 写盘失败，这些用户的修改仍未保存
+            chat_contexts_dirty.set() # 让后台刷盘线程和退出时的刷盘继续重试
+
+def write_chat_contexts(contexts_to_save):
+    """将上下文快照原子地写入文件（调用方应持有 chat_contexts_file_lock），返回是否成功。"""
+    global chat_contexts_mtime
     temp_file_path = CHAT_CONTEXTS_FILE + ".tmp"
     try:
-        # 创建要保存的上下文副本，以防在写入时被其他线程修改
-        # 如果在 queue_lock 保护下调用，则直接使用全局 chat_contexts 即可
-        contexts_to_save = dict(chat_contexts) # 创建浅拷贝
-
-        with open(temp_file_path, 'w', encoding='utf-8') as f:
-            json.dump(contexts_to_save, f, ensure_ascii=False, indent=4)
-        shutil.move(temp_file_path, CHAT_CONTEXTS_FILE) # 原子替换
+        if orjson is not None:
+            # orjson 只支持2空格缩进，内容与 json 写出的等价，配置编辑器可照常读取
+            with open(temp_file_path, 'wb') as f:
+                f.write(orjson.dumps(contexts_to_save, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        else:
+            with open(temp_file_path, 'w', encoding='utf-8') as f:
+                json.dump(contexts_to_save, f, ensure_ascii=False, indent=4)
+        os.replace(temp_file_path, CHAT_CONTEXTS_FILE) # 原子替换
+        chat_contexts_mtime = get_chat_contexts_mtime()
         logger.debug(f"聊天上下文已成功保存到 {CHAT_CONTEXTS_FILE}")
+        return True
     except Exception as e:
         logger.error(f"保存聊天上下文到 {CHAT_CONTEXTS_FILE} 失败: {e}", exc_info=True)
         if os.path.exists(temp_file_path):
@@ -607,14 +728,29 @@ def save_chat_contexts():
                 os.remove(temp_file_path) # 清理临时文件
             except OSError:
                 pass # 忽略清理错误
+        return False
 
-def strip_before_thought_tags(text):
-    # 匹配并截取 </thought> 或 </think> 后面的内容
-    match = re.search(r'(?:</thought>|</think>)([\s\S]*)', text)
-    if match:
-        return match.group(1)
-    else:
-        return text
+def mark_chat_contexts_dirty():
+    """标记上下文已修改，由后台线程合并多次修改后统一写盘。"""
+    global chat_contexts_flusher_thread
+    if chat_contexts_flusher_thread is None:
+        with chat_contexts_flusher_lock:
+            if chat_contexts_flusher_thread is None:
+                chat_contexts_flusher_thread = threading.Thread(target=chat_contexts_flusher, name="ChatContextsFlusher", daemon=True)
+                chat_contexts_flusher_thread.start()
+    chat_contexts_dirty.set()
+
+def flush_chat_contexts():
+    """如有未写盘的修改，立即保存上下文。"""
+    if chat_contexts_dirty.is_set():
+        save_chat_contexts()
+
+def chat_contexts_flusher():
+    """后台线程：等待上下文修改，短暂合并后写盘，避免每轮对话都同步写文件。"""
+    while True:
+        chat_contexts_dirty.wait()
+        time.sleep(CHAT_CONTEXTS_FLUSH_DELAY)
+        flush_chat_contexts()
 
 def get_assistant_response(message, user_id, is_summary=False):
     """
@@ -651,6 +787,14 @@ def get_assistant_response(message, user_id, is_summary=False):
         from ai_platforms.llm_direct import get_deepseek_response
         return get_deepseek_response(message, user_id, store_context=False, is_summary=is_summary)
 
+# 辅助模型错误分类规则表：沿用主模型的规则表，只替换敏感词的提示信息
+ASSISTANT_SENSITIVE_WORDS_MESSAGE = "错误：提示词中含有敏感词，无法生成回复，请联系API服务商！"
+ASSISTANT_API_ERROR_RULES = tuple(
+    (keywords, (ASSISTANT_SENSITIVE_WORDS_MESSAGE,) + result[1:]) if "sensitive words detected" in keywords else (keywords, result)
+    for keywords, result in CHAT_API_ERROR_RULES
+)
+classify_assistant_api_error = compile_error_classifier(ASSISTANT_API_ERROR_RULES)
+
 def call_assistant_api_with_retry(messages_to_send, user_id, max_retries=2, is_summary=False):
     """
     调用辅助模型 API 并在第一次失败或返回空结果时重试。
@@ -664,6 +808,7 @@ def call_assistant_api_with_retry(messages_to_send, user_id, max_retries=2, is_s
         str: 辅助模型返回的文本回复。
     """
     attempt = 0
+    messages_dump = None  # 错误日志用的消息体，首次出错时才格式化，重试间复用
     while attempt <= max_retries:
         try:
             logger.debug(f"发送给辅助模型 API 的消息 (ID: {user_id}): {messages_to_send}")
@@ -692,43 +837,35 @@ def call_assistant_api_with_retry(messages_to_send, user_id, max_retries=2, is_s
             # 记录错误日志
             logger.error("辅助模型错误请求消息体:")
             logger.error(f"{ASSISTANT_MODEL}")
-            logger.error(json.dumps(messages_to_send, ensure_ascii=False, indent=2))
+            if logger.isEnabledFor(logging.ERROR):
+                messages_dump = messages_dump or dump_messages(messages_to_send)
+                logger.error(messages_dump)
             logger.error("辅助模型 API 返回了空的选择项或内容为空。")
             logger.error(f"完整响应对象: {response}")
 
         except Exception as e:
             logger.error("辅助模型错误请求消息体:")
             logger.error(f"{ASSISTANT_MODEL}")
-            logger.error(json.dumps(messages_to_send, ensure_ascii=False, indent=2))
+            if logger.isEnabledFor(logging.ERROR):
+                messages_dump = messages_dump or dump_messages(messages_to_send)
+                logger.error(messages_dump)
             error_info = str(e)
             logger.error(f"辅助模型自动重试：第 {attempt + 1} 次调用失败 (ID: {user_id}) 原因: {error_info}", exc_info=False)
 
-            # 细化错误分类
-            if "real name verification" in error_info:
-                logger.error("\033[31m错误：API 服务商反馈请完成实名认证后再使用！\033[0m")
-                break  # 终止循环，不再重试
-            elif "rate limit" in error_info:
-                logger.error("\033[31m错误：API 服务商反馈当前访问 API 服务频次达到上限，请稍后再试！\033[0m")
-            elif "payment required" in error_info:
-                logger.error("\033[31m错误：API 服务商反馈您正在使用付费模型，请先充值再使用或使用免费额度模型！\033[0m")
-                break  # 终止循环，不再重试
-            elif "user quota" in error_info or "is not enough" in error_info or "UnlimitedQuota" in error_info:
-                logger.error("\033[31m错误：API 服务商反馈，你的余额不足，请先充值再使用! 如有余额，请检查令牌是否为无限额度。\033[0m")
-                break  # 终止循环，不再重试
-            elif "Api key is invalid" in error_info:
-                logger.error("\033[31m错误：API 服务商反馈 API KEY 不可用，请检查配置选项！\033[0m")
-            elif "service unavailable" in error_info:
-                logger.error("\033[31m错误：API 服务商反馈服务器繁忙，请稍后再试！\033[0m")
-            elif "sensitive words detected" in error_info:
-                logger.error("\033[31m错误：提示词中含有敏感词，无法生成回复，请联系API服务商！\033[0m")
-                if ENABLE_SENSITIVE_CONTENT_CLEARING:
+            # 细化错误分类（单次正则扫描所有关键词，按规则表优先级取结果）
+            matched = classify_assistant_api_error(error_info)
+            if matched is None:
+                logger.error("\033[31m未知错误：" + error_info + "\033[0m")
+            else:
+                message, stop_retry, clear_context = matched
+                logger.error(f"\033[31m{message}\033[0m")
+                if clear_context and ENABLE_SENSITIVE_CONTENT_CLEARING:
                     logger.warning(f"已开启敏感词自动清除上下文功能，开始清除用户 {user_id} 的聊天上下文")
                     clear_chat_context(user_id)
                     if is_summary:
                         clear_memory_temp_files(user_id)  # 如果是总结任务，清除临时文件
-                break  # 终止循环，不再重试
-            else:
-                logger.error("\033[31m未知错误：" + error_info + "\033[0m")
+                if stop_retry:
+                    break  # 终止循环，不再重试
 
         attempt += 1
 
@@ -1304,10 +1441,24 @@ def check_inactive_users():
                     inactive_users.append(username)
 
         for username in inactive_users:
-            process_user_messages(username)
+            with processing_users_lock:
+                if username in processing_users:
+                    continue  # 该用户上一批消息仍在处理中，新消息留在队列里等下一轮
+                processing_users.add(username)
+            message_worker_pool.submit(process_user_messages_task, username)
 
         time.sleep(1)  # 每秒检查一次
 
+def process_user_messages_task(user_id):
+    """在工作线程中处理用户消息，结束后清除该用户的处理中标记。"""
+    try:
+        process_user_messages(user_id)
+    except Exception as e:
+        logger.error(f"处理用户 {user_id} 的消息时发生未捕获的异常: {str(e)}", exc_info=True)
+    finally:
+        with processing_users_lock:
+            processing_users.discard(user_id)
+
 def process_user_messages(user_id):
     """处理指定用户的消息队列，包括可能的联网搜索。"""
     global can_send_messages # 引用全局变量
@@ -1450,16 +1601,10 @@ def send_complete_message(user_id, message):
         logger.warning(f"尝试向 {user_id} 发送空消息。")
         return
 
-    # 等待发送队列
-    wait_start_time = time.time()
-    MAX_WAIT_SENDING = 15.0
-    while is_sending_message:
-        if time.time() - wait_start_time > MAX_WAIT_SENDING:
-            logger.warning(f"等待 is_sending_message 标志超时，准备向 {user_id} 发送完整消息，继续执行。")
-            break
+    # 等待其他发送完成（多个用户的消息在线程池中并发处理，发送必须串行）
+    if is_sending_message:
         logger.debug(f"等待向 {user_id} 发送完整消息，另一个发送正在进行中。")
-        time.sleep(0.5)
-
+    wx_send_lock.acquire()
     try:
         is_sending_message = True
         logger.info(f"准备向 {user_id} 发送完整消息（不分段）")
@@ -1473,6 +1618,7 @@ def send_complete_message(user_id, message):
         logger.error(f"向 {user_id} 发送完整消息失败: {str(e)}", exc_info=True)
     finally:
         is_sending_message = False
+        wx_send_lock.release()
 
 def send_reply(user_id, sender_name, username, original_merged_message, reply):
     """发送回复消息，可能分段发送，并管理发送标志。"""
@@ -1481,16 +1627,10 @@ def send_reply(user_id, sender_name, username, original_merged_message, reply):
         logger.warning(f"尝试向 {user_id} 发送空回复。")
         return
 
-    # --- 如果正在发送，等待 ---
-    wait_start_time = time.time()
-    MAX_WAIT_SENDING = 15.0  # 最大等待时间（秒）
-    while is_sending_message:
-        if time.time() - wait_start_time > MAX_WAIT_SENDING:
-            logger.warning(f"等待 is_sending_message 标志超时，准备向 {user_id} 发送回复，继续执行。")
-            break  # 避免无限等待
+    # --- 如果正在发送，等待（多个用户的消息在线程池中并发处理，发送必须串行）---
+    if is_sending_message:
         logger.debug(f"等待向 {user_id} 发送回复，另一个发送正在进行中。")
-        time.sleep(0.5)  # 短暂等待
-
+    wx_send_lock.acquire()
     try:
         is_sending_message = True  # <<< 在发送前设置标志
         logger.info(f"准备向 {sender_name} (用户ID: {user_id}) 发送消息")
@@ -1555,6 +1695,7 @@ def send_reply(user_id, sender_name, username, original_merged_message, reply):
         logger.error(f"向 {user_id} 发送回复失败: {str(e)}", exc_info=True)
     finally:
         is_sending_message = False
+        wx_send_lock.release()
 
 def split_message_with_context(text):
     """
@@ -2482,10 +2623,12 @@ def clear_chat_context(user_id):
     logger.info(f"已开启自动清除上下文功能，尝试清除用户 {user_id} 的聊天上下文")
     try:
         with queue_lock:
-            if user_id in chat_contexts:
-                del chat_contexts[user_id]
-                save_chat_contexts()
-                logger.warning(f"已清除用户 {user_id} 的聊天上下文")
+            if user_id not in chat_contexts:
+                return
+            del chat_contexts[user_id]
+            chat_contexts_dirty_users.add(user_id)
+        mark_chat_contexts_dirty()
+        logger.warning(f"已清除用户 {user_id} 的聊天上下文")
     except Exception as e:
         logger.error(f"清除聊天上下文失败: {str(e)}")
 
@@ -3632,8 +3775,7 @@ def scheduled_restart_checker():
                 try:
                     # --- 执行重启前的清理操作 ---
                     logger.info("定时重启前：保存聊天上下文...")
-                    with queue_lock:
-                        save_chat_contexts()
+                    save_chat_contexts()
                     
                     # 保存用户计时器状态
                     if ENABLE_AUTO_MESSAGE:
@@ -3961,6 +4103,10 @@ def main():
     finally:
         logger.info("程序准备退出，执行清理操作...")
 
+        # 保存尚未写盘的聊天上下文
+        logger.info("程序退出前：保存聊天上下文...")
+        flush_chat_contexts()
+
         # 保存用户计时器状态（如果启用了自动消息）
         if ENABLE_AUTO_MESSAGE:
             logger.info("程序退出前：保存用户计时器状态...")